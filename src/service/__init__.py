@@ -1,2 +1,2 @@
 __name__ = 'service'
-__all__ = [ 'core', 'daemon', 'client', 'agent', 'manager' ]
+__all__ = [ 'core', 'daemon', 'client', 'agent', 'manager', 'pool', 'codec', 'cache', 'stats', 'trace', 'ha', 'inventory', 'registry', 'sockopts' ]
@@ -29,12 +29,32 @@ Service Manager Agent module
 
 import logging
 import platform
+import itertools
+import threading
+
+from time import time
 
 import zmq
 
+from service import codec
+from service import trace
+from service import sockopts
+from service.cache import StatusCache
 from service.core import Service
+from service.core import ServiceResolver
 from service.core import ServiceManagerException
 from service.daemon import Daemon
+from service.inventory import ServiceInventory
+from service.pool import WorkerPool
+from service.stats import Stats
+from service.stats import metric
+
+# Keys of the metrics updated for every message received
+SUB_MESSAGES     = metric('messages_total', socket='sub')
+RESULTS_MESSAGES = metric('messages_total', socket='results')
+MGMT_MESSAGES    = metric('messages_total', socket='mgmt')
+SERVICE_REQUESTS = metric('requests_total', type='service')
+BATCH_REQUESTS   = metric('requests_total', type='batch')
 
 class ServiceManagerAgent(Daemon):
     """
@@ -58,21 +78,106 @@ class ServiceManagerAgent(Daemon):
         # Create the Service Manager Agent sockets
         self.create_sockets(**kwargs)
 
+        # Output of service requests larger than the threshold is compressed
+        self.compress_threshold = int(kwargs.get('compress_threshold', 0))
+        self.compression = kwargs.get('compression', 'zlib')
+
+        if self.compression not in codec.compressors:
+            raise ServiceManagerException, 'Compression %s is not available' % self.compression
+
+        # Runtime metrics, which are optionally dumped to a file
+        # in the Prometheus text format every stats interval
+        self.stats = Stats('service_mgr_agent')
+        self.stats_file = kwargs.get('stats_file')
+        self.stats_interval = float(kwargs.get('stats_interval', 10.0))
+        self.stats_next = time()
+
+        # Results of status requests are cached for that amount of seconds
+        status_cache_ttl = float(kwargs.get('status_cache_ttl', 0))
+        status_cache_size = int(kwargs.get('status_cache_size', 1024))
+        self.status_cache = StatusCache(status_cache_ttl, status_cache_size) if status_cache_ttl > 0 else None
+
+        # Location of service(8) and the host facts are resolved
+        # once and shared by all service requests
+        self.resolver = ServiceResolver()
+
+        # Index of the installed services, so that service requests
+        # for unknown services are answered without running service(8)
+        self.inventory = None
+
+        if kwargs.get('service_inventory', 'yes').lower() in ('1', 'yes', 'true', 'on'):
+            directories = None
+
+            if kwargs.get('inventory_dirs'):
+                directories = [ (d.split(':', 1) + [ None ])[:2] for d in kwargs['inventory_dirs'].split(',') ]
+
+            self.inventory = ServiceInventory(float(kwargs.get('inventory_interval', 30.0)), directories)
+
+        # Service requests are executed by a pool of workers, so
+        # that a slow service request does not block the main loop
+        self.pool = WorkerPool(
+            size=int(kwargs.get('pool_size', 4)),
+            zcontext=self.zcontext,
+            endpoint=self.results_endpoint
+        )
+        self.pool.start()
+
+        # Service requests received while that many tasks are
+        # queued are rejected with a busy result right away
+        self.max_queued = int(kwargs.get('max_queued', 1000))
+
+        # Seconds a service(8) command may run for before it is killed,
+        # unless the service request carries an "exec_timeout" of its own
+        self.exec_timeout = float(kwargs.get('exec_timeout', 300.0))
+
+        # Events to set for cancelling the service requests in flight
+        self.cancels = {}
+
+        # Services checked every watch interval, whose state changes
+        # are pushed to the Service Manager, which republishes them
+        self.watch_services = [ w.strip() for w in kwargs.get('watch_services', '').split(',') if w.strip() ]
+        self.watch_interval = float(kwargs.get('watch_interval', 10.0))
+        self.watch_next = time()
+        self.watch_states = {}
+        self.watch_inflight = set()
+
+        # Heartbeats let the Service Manager know we are alive
+        self.heartbeat_interval = float(kwargs.get('heartbeat_interval', 5.0))
+        self.heartbeat_next = time()
+
+        self.stats.gauge('queued_tasks', self.pool.queued)
+        self.stats.gauge('status_cache_entries', lambda: len(self.status_cache) if self.status_cache is not None else 0)
+
         logging.info('Service Manager Agent started')
 
         # Main daemon loop
         while not self.time_to_die:
-            socks = dict(self.zpoller.poll())
+            socks = dict(self.zpoller.poll(self.poll_timeout()))
+
+            # Subscriber sockets, receive service request messages
+            for index, eachSocket in enumerate(self.sub_sockets):
+                if socks.get(eachSocket):
+                    self.process_sub_msg(index)
 
-            # Subscriber socket, receives service request messages
-            if socks.get(self.sub_socket):
-                self.process_sub_msg()
+            # Results socket, receives results from the worker pool
+            if socks.get(self.results_socket):
+                self.process_results_msg()
 
             # Management socket, receives management messages
             if socks.get(self.mgmt_socket):
                 self.process_mgmt_msg()
 
+            # Check the watched services if the watch interval has passed
+            self.schedule_watch()
+
+            # Let the Service Manager know we are alive
+            self.send_heartbeat()
+
+            # Dump the metrics if the stats interval has passed
+            self.dump_stats()
+
         # Shutdown time has arrived, let's cleanup a bit here
+        self.pool.stop()
         self.close_sockets()
         self.stop()
         
@@ -80,6 +185,12 @@ class ServiceManagerAgent(Daemon):
         """
         Creates the Service Manager Agent sockets
 
+        The manager and sink endpoints may be comma-separated lists,
+        e.g. of a high-availability pair of Service Managers, in which
+        case a subscriber and a sink socket are connected to each
+        Service Manager. Results are pushed to the sink of the Service
+        Manager we received the latest service request from.
+
         """
         logging.debug('Creating Service Manager Agent sockets')
 
@@ -95,7 +206,13 @@ class ServiceManagerAgent(Daemon):
         for k in kwargs:
             setattr(self, k, kwargs[k])
 
-        # Service Manager Subscriber socket
+        manager_endpoints = [ e.strip() for e in self.manager_endpoint.split(',') ]
+        sink_endpoints = [ e.strip() for e in self.sink_endpoint.split(',') ]
+
+        if len(manager_endpoints) != len(sink_endpoints):
+            raise ServiceManagerException, 'Every manager endpoint should have a matching sink endpoint'
+
+        # Service Manager Subscriber sockets
         # Subscribe to every topic defined in the conf file.
         #
         # Also subscribe to topics related to the platform on
@@ -107,21 +224,48 @@ class ServiceManagerAgent(Daemon):
         # broadcasting messages to all Agents
         #
         self.zcontext = zmq.Context().instance()
-        self.sub_socket = self.zcontext.socket(zmq.SUB)
+        self.sub_sockets = [ self.zcontext.socket(zmq.SUB) for _ in manager_endpoints ]
+
+        topics = [ "any", platform.system(), platform.node() ]
 
         if hasattr(self, 'topics'):
-            for eachTopic in self.topics.split(','):
-                self.sub_socket.setsockopt(zmq.SUBSCRIBE, eachTopic)
+            topics = self.topics.split(',') + topics
+
+        for eachSocket in self.sub_sockets:
+            for eachTopic in topics:
+                eachSocket.setsockopt(zmq.SUBSCRIBE, eachTopic)
 
-        self.sub_socket.setsockopt(zmq.SUBSCRIBE, "any")
-        self.sub_socket.setsockopt(zmq.SUBSCRIBE, platform.system())
-        self.sub_socket.setsockopt(zmq.SUBSCRIBE, platform.node())
+        self.subscribed_topics = topics
         
-        self.sink_socket = self.zcontext.socket(zmq.PUSH)
+        self.sink_sockets = [ self.zcontext.socket(zmq.PUSH) for _ in sink_endpoints ]
+        self.sink_socket = self.sink_sockets[0]
         self.mgmt_socket = self.zcontext.socket(zmq.REP)
 
-        self.sub_socket.connect(self.manager_endpoint)
-        self.sink_socket.connect(self.sink_endpoint)
+        # High-water marks, buffer sizes and TCP keepalive from the conf file
+        for eachSocket in self.sub_sockets:
+            sockopts.configure(eachSocket, 'manager', kwargs)
+
+        for eachSocket in self.sink_sockets:
+            sockopts.configure(eachSocket, 'sink', kwargs)
+
+        sockopts.configure(self.mgmt_socket, 'mgmt', kwargs)
+
+        # Last sequence number received for each topic from each
+        # Service Manager, and the number of messages found missing
+        self.backend_seqs = {}
+        self.dropped = 0
+
+        # Results socket, collects results from the worker pool.
+        # Only the main loop sends messages on the sink socket.
+        self.results_endpoint = 'inproc://service-mgr-agent-results'
+        self.results_socket = self.zcontext.socket(zmq.PULL)
+        self.results_socket.bind(self.results_endpoint)
+
+        for eachSocket, eachEndpoint in zip(self.sub_sockets, manager_endpoints):
+            eachSocket.connect(eachEndpoint)
+
+        for eachSocket, eachEndpoint in zip(self.sink_sockets, sink_endpoints):
+            eachSocket.connect(eachEndpoint)
 
         try:
             self.mgmt_socket.bind(self.mgmt_endpoint)
@@ -130,7 +274,11 @@ class ServiceManagerAgent(Daemon):
 
         # Create a poll set for our sockets
         self.zpoller = zmq.Poller()
-        self.zpoller.register(self.sub_socket, zmq.POLLIN)
+
+        for eachSocket in self.sub_sockets:
+            self.zpoller.register(eachSocket, zmq.POLLIN)
+
+        self.zpoller.register(self.results_socket, zmq.POLLIN)
         self.zpoller.register(self.mgmt_socket, zmq.POLLIN)
 
     def close_sockets(self):
@@ -140,18 +288,183 @@ class ServiceManagerAgent(Daemon):
         """
         logging.debug('Closing Service Manager Agent sockets')
 
-        self.zpoller.unregister(self.sub_socket)
+        for eachSocket in self.sub_sockets:
+            self.zpoller.unregister(eachSocket)
+            eachSocket.close()
+
+        for eachSocket in self.sink_sockets:
+            eachSocket.close()
+
+        self.zpoller.unregister(self.results_socket)
         self.zpoller.unregister(self.mgmt_socket)
 
-        self.sub_socket.close()
-        self.sink_socket.close()
+        self.results_socket.close()
         self.mgmt_socket.close()
 
         self.zcontext.destroy()
 
-    def process_sub_msg(self):
+    def poll_timeout(self):
+        """
+        Get the time to wait for messages in the main daemon loop
+
+        Returns:
+            The number of milliseconds until the metrics should be dumped,
+            the watched services should be checked or a heartbeat should
+            be sent, or None if there is nothing to wait for
+
+        """
+        deadlines = []
+
+        if self.heartbeat_interval > 0:
+            deadlines.append(self.heartbeat_next)
+
+        if self.stats_file:
+            deadlines.append(self.stats_next)
+
+        if self.watch_services:
+            deadlines.append(self.watch_next)
+
+        if not deadlines:
+            return None
+
+        return max(0, (min(deadlines) - time()) * 1000)
+
+    def dump_stats(self):
+        """
+        Dumps the metrics to the stats file, if the stats interval has passed
+
+        """
+        if not self.stats_file or time() < self.stats_next:
+            return
+
+        self.stats.dump(self.stats_file)
+        self.stats_next = time() + self.stats_interval
+
+    def send_heartbeat(self):
+        """
+        Sends a heartbeat to the Service Manager, if the heartbeat interval has passed
+
+        The heartbeat is sent to the sink of each Service Manager we are
+        connected to, and carries the details the Service Manager keeps
+        in its registry of the Agents which are alive:
+
+            {
+                "heartbeat": {
+                    "node":     "<node>",
+                    "system":   "FreeBSD",
+                    "version":  "<os-version>",
+                    "topics":   [ "any", "FreeBSD", "<node>", ... ],
+                    "interval": <seconds-until-the-next-heartbeat>,
+                    "dropped":  <number-of-messages-found-missing>,
+                }
+            }
+
+        """
+        if self.heartbeat_interval <= 0 or time() < self.heartbeat_next:
+            return
+
+        frames = codec.envelope(codec.HEARTBEAT, {
+            'heartbeat': {
+                'node':     self.resolver.node,
+                'system':   self.resolver.system,
+                'version':  self.resolver.version,
+                'topics':   self.subscribed_topics,
+                'interval': self.heartbeat_interval,
+                'dropped':  self.dropped,
+            }
+        })
+
+        # A Service Manager which is gone should not block us
+        for eachSocket in self.sink_sockets:
+            try:
+                eachSocket.send_multipart(frames, zmq.NOBLOCK)
+            except zmq.Again:
+                logging.warning('Unable to send heartbeat, Service Manager is not responding')
+
+        self.heartbeat_next = time() + self.heartbeat_interval
+
+    def schedule_watch(self):
+        """
+        Submits checks of the watched services, if the watch interval has passed
+
+        A service whose previous check is still running is skipped,
+        so that a hanging service does not pile up checks in the pool.
+
+        """
+        if not self.watch_services or time() < self.watch_next:
+            return
+
+        for eachService in self.watch_services:
+            if eachService in self.watch_inflight:
+                continue
+
+            self.watch_inflight.add(eachService)
+            self.pool.submit(eachService, self.process_watch_task, eachService)
+
+        self.watch_next = time() + self.watch_interval
+
+    def process_watch_task(self, service):
+        """
+        Checks the status of a watched service on a worker of the pool
+
+        Only changes of the state of the service, i.e. of the return code
+        of its status command, are pushed to the Service Manager sink.
+        The first check of a service is reported as a change as well.
+
+            {
+                "watch": {
+                    "node":       "<node>",
+                    "service":    "sshd",
+                    "returncode": 0,
+                    "previous":   3,
+                    "stdout":     [ "sshd is running as pid 1234.", "" ],
+                    "time":       <unix-timestamp-of-the-check>,
+                }
+            }
+
+        Args:
+            service (str): Name of the service
+
+        Returns:
+            The encoded state change message, or None if the state did not change
+
+        """
+        try:
+            self.stats.incr('watch_checks_total')
+
+            s = Service(service, self.resolver, self.stats)
+            result = s.run_cmd('status', timeout=self.exec_timeout)
+
+            # The check is as fresh as it gets, so keep it for status requests
+            if self.status_cache is not None and 'result' in result and not result['result'].get('timeout'):
+                self.status_cache.put(service, result)
+
+            details = result.get('result', {})
+            returncode = details.get('returncode')
+            previous = self.watch_states.get(service)
+
+            if service in self.watch_states and returncode == previous:
+                return None
+
+            self.watch_states[service] = returncode
+            self.stats.incr('watch_changes_total')
+
+            return codec.envelope(codec.WATCH, {
+                'watch': {
+                    'node':       s.node,
+                    'service':    service,
+                    'returncode': returncode,
+                    'previous':   previous,
+                    'stdout':     details.get('stdout', [ result.get('msg', '') ]),
+                    'time':       time(),
+                }
+            })
+        finally:
+            self.watch_inflight.discard(service)
+
+    def process_sub_msg(self, index=0):
         """
-        Processes a message on the subscriber socket
+        Processes a message on a subscriber socket
 
         The message we receive on the subscriber socket:
 
@@ -177,22 +490,343 @@ class ServiceManagerAgent(Daemon):
                 "uuid":    "<unique-client-request-id>",
             }
 
+        If the message also contains "stream": true, the output of the
+        service request is pushed to the Service Manager sink in chunks
+        while the request is running. Chunk messages look like this:
+
+            {
+                "uuid":  "<unique-client-request-id>",
+                "chunk": {
+                    "node":    "<node>",
+                    "service": "sshd",
+                    "seq":     0,
+                    "stream":  "stdout",
+                    "data":    "<output>",
+                }
+            }
+
+        The final result message of a streaming request
+        contains "eos": true to mark the end of the stream.
+
+        If the message contains a "trace" dict, the time the message was
+        received and the time the service request was started and finished
+        at are added to it, and the trace is included in the result message.
+
+        Service requests received while "max_queued" tasks are waiting
+        for a worker are not queued, but answered with a busy result.
+
+        The service(8) command of a service request is killed once it runs
+        for longer than the "exec_timeout" of the message, or the one in the
+        conf file. The Service Manager cancels service requests in flight by
+        sending the request id to all Agents:
+
+            {
+                "cancel": "<unique-client-request-id>",
+            }
+
+        A message carrying a "node" is only processed by the Agent on that
+        node, as the node name topic of our node is a prefix of the topics
+        of other nodes whose names start with the name of our node.
+
+        A single message may also carry a batch of service requests,
+        in which case a single combined result is sent back once every
+        service request in the batch has been executed:
+
+            {
+                "batch": [
+                    { "cmd": "status", "service": "sshd" },
+                    { "cmd": "status", "service": "cron" },
+                ],
+                "topic":   "FreeBSD",
+                "uuid":    "<unique-client-request-id>",
+            }
+
+        Only the active Service Manager of a high-availability pair sends
+        service requests, so results are pushed to the sink of the Service
+        Manager which sent the latest service request.
+
+        Args:
+            index (int): Index of the subscriber socket the message arrived on
+
         """
         logging.debug('Received new message on the subscriber socket')
 
-        topic = self.sub_socket.recv_unicode()
-        msg = self.sub_socket.recv_json()
+        self.stats.incr(SUB_MESSAGES)
+
+        sub_socket = self.sub_sockets[index]
+        self.sink_socket = self.sink_sockets[index]
+
+        topic = sub_socket.recv_unicode()
+        msg, _codec = codec.recv(sub_socket)
 
         logging.debug('Topic: %s', topic)
         logging.debug('Message: %s', msg)
 
-        result = self.process_service_req(msg)
-                
+        self.check_seq(index, topic, msg.get('seq'))
+
+        if 'cancel' in msg:
+            self.cancel_request(msg['cancel'])
+            return
+
+        # Service requests for another node whose name starts
+        # with the name of our node, e.g. of rolling requests
+        if msg.get('node', self.resolver.node) != self.resolver.node:
+            logging.debug('Ignoring service request for node %s', msg['node'])
+            return
+
+        trace.stamp(msg, 'agent_received')
+
+        if self.max_queued and self.pool.queued() >= self.max_queued:
+            self.send_busy(msg)
+            return
+
+        if 'batch' in msg:
+            self.stats.incr(BATCH_REQUESTS)
+            self.process_batch_msg(msg)
+            return
+
+        self.stats.incr(SERVICE_REQUESTS)
+        self.cancels[msg['uuid']] = threading.Event()
+
+        # Requests for the same service are always routed to the
+        # same worker, so they are executed in the order received
+        self.pool.submit(msg.get('service'), self.process_service_task, msg)
+
+    def check_seq(self, index, topic, seq):
+        """
+        Checks the sequence number of a message for messages which were dropped
+
+        The Service Manager numbers the messages of each topic, so a gap
+        means that messages were dropped on their way to us, e.g. because
+        the high-water mark was reached. The Service Manager learns the
+        number of dropped messages from our heartbeats.
+
+        Args:
+            index  (int): Index of the subscriber socket the message arrived on
+            topic  (str): The topic of the message
+            seq    (int): The sequence number of the message, if any
+
+        """
+        if seq is None:
+            return
+
+        key = (index, topic)
+        last = self.backend_seqs.get(key)
+        self.backend_seqs[key] = seq
+
+        # A lower sequence number means that the Service Manager restarted
+        if last is not None and seq > last + 1:
+            logging.warning('Missed %d messages with topic %s', seq - last - 1, topic)
+            self.dropped += seq - last - 1
+            self.stats.incr('dropped_requests_total', seq - last - 1)
+
+    def cancel_request(self, req_id):
+        """
+        Cancels a service request in flight
+
+        Service requests still waiting for a worker are not executed, and
+        the service(8) commands of running ones are killed. Their results
+        are sent back as usual, marked with "cancelled": true.
+
+        Args:
+            req_id (str): The unique request id of the service request
+
+        """
+        cancelled = self.cancels.get(req_id)
+
+        if cancelled is None:
+            logging.debug('No service request %s to cancel', req_id)
+            return
+
+        logging.info('Cancelling service request %s', req_id)
+
+        self.stats.incr('requests_cancelled_total')
+        cancelled.set()
+
+    def send_busy(self, msg):
+        """
+        Sends a busy result for a service request we have no room for
+
+            {
+                "success": -1,
+                "busy":    true,
+                "msg":     "Service Manager Agent is busy",
+                "node":    "<node>",
+                "uuid":    "<unique-client-request-id>",
+            }
+
+        Args:
+            msg (dict): The service request
+
+        """
+        logging.warning('Rejecting service request %s, %d tasks are queued', msg['uuid'], self.pool.queued())
+
+        self.stats.incr('requests_busy_total')
+
+        result = {
+            'success': -1,
+            'busy':    True,
+            'msg':     'Service Manager Agent is busy',
+            'node':    self.resolver.node,
+            'uuid':    msg['uuid'],
+        }
+
+        # The busy result ends the stream of a streaming request
+        if msg.get('stream'):
+            result['eos'] = True
+
+        if 'trace' in msg:
+            result['trace'] = msg['trace']
+
+        self.sink_socket.send_multipart(self.encode_result(result, self.result_codec(msg)))
+
+    def process_batch_msg(self, msg):
+        """
+        Processes a batch of service requests
+
+        Each service request in the batch is submitted to the worker
+        pool on its own, so that the ordering of requests for the same
+        service is preserved. The worker completing the last service
+        request in the batch sends back the combined result.
+
+        Args:
+            msg (dict): The message containing the batch of service requests
+
+        """
+        batch = msg['batch']
+
+        if not isinstance(batch, list) or not batch:
+            self.stats.incr('request_errors_total')
+            self.sink_socket.send_multipart(self.encode_result({
+                'success': -1,
+                'msg': 'Batch should be a non-empty list of service requests',
+                'uuid': msg['uuid'],
+            }, self.result_codec(msg)))
+            return
+
+        collector = BatchCollector(msg, self.resolver, self.result_codec(msg))
+        self.cancels[msg['uuid']] = threading.Event()
+
+        for index, item in enumerate(batch):
+            # Only plain service requests are supported within a batch
+            if isinstance(item, dict):
+                item = dict((k, item[k]) for k in ('cmd', 'service') if k in item)
+            else:
+                item = {}
+
+            # The batch is timed out and cancelled as a whole
+            item['uuid'] = msg['uuid']
+
+            if 'exec_timeout' in msg:
+                item['exec_timeout'] = msg['exec_timeout']
+
+            self.pool.submit(item.get('service'), self.process_batch_task, collector, index, item)
+
+    def process_batch_task(self, collector, index, item):
+        """
+        Executes a service request from a batch on a worker of the pool
+
+        Args:
+            collector  (BatchCollector): Collector of the batch results
+            index                 (int): Index of the service request in the batch
+            item                 (dict): The service request details
+
+        Returns:
+            The encoded combined result message if this was
+            the last service request of the batch, None otherwise
+
+        """
+        started = time()
+        result = collector.add(index, self.process_service_req(item), started)
+
+        if result is None:
+            return None
+
+        self.cancels.pop(collector.uuid, None)
+
+        return self.encode_result(result, collector.codec)
+
+    def process_results_msg(self):
+        """
+        Processes a message on the results socket
+
+        The results socket receives the results of service requests
+        executed by the worker pool, which are then pushed
+        to the Service Manager sink.
+
+        """
+        logging.debug('Received new message on the results socket')
+
+        self.stats.incr(RESULTS_MESSAGES)
+
+        self.sink_socket.send_multipart(self.results_socket.recv_multipart())
+
+    def process_service_task(self, msg):
+        """
+        Executes a service request on a worker of the pool
+
+        Args:
+            msg (dict): The message containing the service request details
+
+        Returns:
+            The encoded result message, which is pushed to the Service Manager sink
+
+        """
+        trace.stamp(msg, 'agent_started')
+
+        try:
+            result = self.process_service_req(msg)
+        finally:
+            self.cancels.pop(msg['uuid'], None)
+
+        trace.stamp(msg, 'agent_finished')
+
         # Add the unique request id to the result message,
         # so that Service Manager publishes it to the clients
         result['uuid'] = msg['uuid']
 
-        self.sink_socket.send_json(result)
+        if 'trace' in msg:
+            result['trace'] = msg['trace']
+
+        return self.encode_result(result, self.result_codec(msg))
+
+    def encode_result(self, result, name):
+        """
+        Encodes a result message
+
+        The output of the service requests within the result
+        is compressed, if it exceeds the compression threshold.
+
+        Args:
+            result (dict): The result message
+            name    (str): Name of the codec to use
+
+        Returns:
+            The frames of the encoded result message, see codec.envelope()
+
+        """
+        if self.compress_threshold > 0:
+            codec.deflate(result, self.compress_threshold, self.compression, name)
+
+        return codec.envelope(codec.TRACED if 'trace' in result else codec.RESULT, result, name)
+
+    def result_codec(self, msg):
+        """
+        Get the codec to use for the results of a service request
+
+        Results are encoded with the codec requested by the client,
+        if it is available, otherwise JSON is used.
+
+        Args:
+            msg (dict): The message containing the service request details
+
+        Returns:
+            The name of the codec
+
+        """
+        name = msg.get('codec', codec.JSON)
+
+        return name if name in codec.codecs else codec.JSON
 
     def process_mgmt_msg(self):
         """
@@ -209,15 +843,20 @@ class ServiceManagerAgent(Daemon):
                 "cmd": "agent.status",
             }
 
+        The reply is encoded with the same codec as the message.
+
         """
         logging.debug('Received new message on the management socket')
+
+        self.stats.incr(MGMT_MESSAGES)
                 
-        msg = self.mgmt_socket.recv_json()
+        msg, name = codec.recv(self.mgmt_socket)
         
         logging.debug('Message: %s' % msg)
 
         if not isinstance(msg, dict):
-            self.mgmt_socket.send_json({ 'success': -1, 'msg': 'Request message should be in JSON format' })
+            codec.send(self.mgmt_socket, { 'success': -1, 'msg': 'Request message should be in JSON format' }, name)
+            return
 
         logging.debug('Processing management request')
 
@@ -227,16 +866,20 @@ class ServiceManagerAgent(Daemon):
         )
         
         if not all(k in msg for k in required_attribs):
-            return { 'success': -1, 'msg': 'Missing message properties' }
+            codec.send(self.mgmt_socket, { 'success': -1, 'msg': 'Missing message properties' }, name)
+            return
 
         mgmt_cmds = {
             'agent.status':   self.agent_status,
+            'agent.stats':    self.agent_stats,
+            'agent.refresh':  self.agent_refresh,
+            'agent.services': self.agent_services,
             'agent.shutdown': self.agent_shutdown,
         }
 
         result = mgmt_cmds[msg['cmd']](msg) if mgmt_cmds.get(msg['cmd']) else { 'success': -1, 'msg': 'Uknown management command requested' }
 
-        self.mgmt_socket.send_json(result)
+        codec.send(self.mgmt_socket, result, name)
 
     def process_service_req(self, msg):
         """
@@ -244,6 +887,18 @@ class ServiceManagerAgent(Daemon):
 
         Executes the user service(8) request returns the results.
 
+        The service(8) command is killed if it does not complete within
+        the execution timeout, or once the service request is cancelled.
+
+        Service requests for services not found in the service inventory
+        are answered right away, without running service(8).
+
+        If the status cache is enabled, the results of status requests
+        are served from the cache while they are valid, and any other
+        command invalidates the cached status of the service. Results
+        always include whether they were served from the cache and
+        the age of the cached entry in seconds.
+
         Args:
             msg (dict): The message containing the service request details
 
@@ -260,14 +915,143 @@ class ServiceManagerAgent(Daemon):
         )
         
         if not all(k in msg for k in required_attribs):
-            return { 'success': -1, 'msg': 'Missing message properties' }
+            self.stats.incr('request_errors_total')
+            return self.uncached({ 'success': -1, 'msg': 'Missing message properties' })
+
+        try:
+            timeout = float(msg.get('exec_timeout', self.exec_timeout))
+        except (TypeError, ValueError):
+            self.stats.incr('request_errors_total')
+            return self.uncached({ 'success': -1, 'msg': 'Execution timeout should be a number' })
+
+        s = Service(msg['service'], self.resolver, self.stats)
+
+        if self.inventory is not None and not self.inventory.contains(msg['service']):
+            self.stats.incr('unknown_services_total')
+            result = self.uncached(self.unknown_service_result(s))
+
+            if msg.get('stream'):
+                result['eos'] = True
+
+            return result
+
+        stream = self.output_streamer(msg, s) if msg.get('stream') else None
+
+        if self.status_cache is not None:
+            # Any command other than status may change the state of the service
+            if msg['cmd'] != 'status':
+                self.status_cache.invalidate(msg['service'])
+            elif not stream:
+                cached = self.status_cache.get(msg['service'])
+
+                if cached is not None:
+                    self.stats.incr('status_cache_hits_total')
+                    result, age = cached
+                    result['result'].update(cached=True, age=age)
+                    return result
+
+                self.stats.incr('status_cache_misses_total')
+
+        result = s.run_cmd(msg['cmd'], stream, timeout, self.cancels.get(msg.get('uuid')))
+        aborted = result.get('result', {}).get('timeout') or result.get('result', {}).get('cancelled')
+
+        if self.status_cache is not None and 'result' in result:
+            if msg['cmd'] == 'status' and not aborted:
+                self.status_cache.put(msg['service'], result)
+
+        self.uncached(result)
+
+        # The final result of a streaming request marks the end of the stream
+        if stream:
+            result['eos'] = True
+
+        return result
+
+    def uncached(self, result):
+        """
+        Marks a result as not served from the status cache
+
+        Errors, which carry no result details, are marked themselves.
+
+        Args:
+            result (dict): The result of a service request
+
+        Returns:
+            The result
+
+        """
+        details = result.get('result')
+        details = details if isinstance(details, dict) else result
+        details.update(cached=False, age=0)
+
+        return result
+
+    def unknown_service_result(self, service):
+        """
+        Get the result of a service request for a service which is not installed
+
+        The result looks like the result of running service(8) for an
+        unknown service, so that nodes are still discovered by sending
+        a request for a service that does not exist.
 
-        s = Service(msg['service'])
+        Args:
+            service (Service): The unknown service
 
-        result = s.run_cmd(msg['cmd'])
+        Returns:
+            The result of the service request
+
+        """
+        result = {
+            'msg': 'Unknown service %s' % service.service_name,
+            'result': {
+                'node':         service.node,
+                'service':      service.service_name,
+                'returncode':   1,
+                'stdout':       [ '' ],
+                'stderr':       [ '%s: unrecognized service' % service.service_name, '' ],
+                'system':       service.system,
+                'version':      service.version,
+                'known':        False,
+            }
+        }
 
         return result
 
+    def output_streamer(self, msg, service):
+        """
+        Creates a callback for streaming the output of a service request
+
+        Each chunk of output is pushed to the Service Manager sink
+        along with the unique request id and a sequence number, so
+        that clients receive output before the request completes.
+
+        Must be called from within a task running on the worker pool.
+
+        Args:
+            msg          (dict): The message containing the service request details
+            service   (Service): The service the request is executed for
+
+        Returns:
+            A callback to be passed to Service.run_cmd()
+
+        """
+        seq = itertools.count()
+        result_codec = self.result_codec(msg)
+
+        def stream(name, data):
+            self.pool.send(codec.envelope(codec.CHUNK, {
+                'uuid': msg['uuid'],
+                'chunk': {
+                    'node':    service.node,
+                    'service': service.service_name,
+                    'seq':     next(seq),
+                    'stream':  name,
+                    'data':    data.decode('utf-8', 'replace'),
+                }
+            }, result_codec))
+
+        return stream
+
     def agent_status(self, msg):
         """
         Get status information about the Service Manager Agent
@@ -285,6 +1069,78 @@ class ServiceManagerAgent(Daemon):
                 'manager_endpoint': self.manager_endpoint,
                 'sink_endpoint': self.sink_endpoint,
                 'mgmt_endpoint': self.mgmt_endpoint,
+                'pool_size': self.pool.size,
+                'service_cmd': self.resolver.path,
+                'status_cache': len(self.status_cache) if self.status_cache is not None else None,
+                'watch_services': dict(self.watch_states),
+                'services': len(self.inventory) if self.inventory is not None else None,
+                'queued': self.pool.queued(),
+                'max_queued': self.max_queued,
+                'dropped': self.dropped,
+                'exec_timeout': self.exec_timeout,
+                'inflight': len(self.cancels),
+            }
+        }
+
+        return result
+
+    def agent_stats(self, msg):
+        """
+        Get the runtime metrics of the Service Manager Agent
+
+        Args:
+            msg (dict): The original message as received on mgmt socket (ignored)
+
+        """
+        result = {
+            'success': 0,
+            'msg': 'Service Manager Agent Stats',
+            'result': self.stats.snapshot(),
+        }
+
+        return result
+
+    def agent_services(self, msg):
+        """
+        Get the services installed on the node of the Service Manager Agent
+
+        Args:
+            msg (dict): The original message as received on mgmt socket (ignored)
+
+        """
+        if self.inventory is None:
+            return { 'success': -1, 'msg': 'Service inventory is disabled' }
+
+        result = {
+            'success': 0,
+            'msg': 'Service Manager Agent Services',
+            'result': self.inventory.snapshot(),
+        }
+
+        return result
+
+    def agent_refresh(self, msg):
+        """
+        Refreshes the location of service(8), the host facts and the service inventory
+
+        Args:
+            msg (dict): The original message as received on the mgmt socket (ignored)
+
+        """
+        self.resolver.refresh()
+
+        if self.inventory is not None:
+            self.inventory.refresh()
+
+        result = {
+            'success': 0,
+            'msg': 'Service Manager Agent refreshed',
+            'result': {
+                'service_cmd': self.resolver.path,
+                'system': self.resolver.system,
+                'node': self.resolver.node,
+                'version': self.resolver.version,
+                'services': len(self.inventory) if self.inventory is not None else None,
             }
         }
 
@@ -303,3 +1159,70 @@ class ServiceManagerAgent(Daemon):
         self.time_to_die = True
 
         return { 'success': 0, 'msg': 'Service Manager Agent is shutting down' }
+
+class BatchCollector(object):
+    """
+    Batch Collector class
+
+    Collects the results of the service requests in a batch,
+    which may complete on different workers of the pool.
+
+    """
+    def __init__(self, msg, resolver, codec):
+        """
+        Initializes a new BatchCollector object
+
+        Args:
+            msg                  (dict): The message containing the batch
+            resolver  (ServiceResolver): Resolver providing the host facts
+            codec                 (str): Codec to use for the combined result
+
+        """
+        self.uuid      = msg['uuid']
+        self.trace     = msg.get('trace')
+        self.started   = None
+        self.codec     = codec
+        self.resolver  = resolver
+        self.results   = [ None ] * len(msg['batch'])
+        self.remaining = len(msg['batch'])
+        self.lock      = threading.Lock()
+
+    def add(self, index, result, started):
+        """
+        Adds the result of a service request from the batch
+
+        Args:
+            index      (int): Index of the service request in the batch
+            result    (dict): The result of the service request
+            started  (float): Time the service request was started at
+
+        Returns:
+            The combined result message once all service
+            requests completed, None otherwise
+
+        """
+        with self.lock:
+            self.results[index] = result
+            self.remaining -= 1
+            self.started = started if self.started is None else min(self.started, started)
+
+            if self.remaining:
+                return None
+
+        result = {
+            'msg': 'Executed batch request',
+            'result': {
+                'node':    self.resolver.node,
+                'system':  self.resolver.system,
+                'version': self.resolver.version,
+                'results': self.results,
+            },
+            'uuid': self.uuid,
+        }
+
+        # The batch is traced as a whole, from the first
+        # service request started until the last one finished
+        if isinstance(self.trace, dict):
+            result['trace'] = dict(self.trace, agent_started=self.started, agent_finished=time())
+
+        return result
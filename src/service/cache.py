@@ -0,0 +1,124 @@
+# Copyright (c) 2014 Marin Atanasov Nikolov <dnaeon@gmail.com>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer
+#    in this position and unchanged.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR(S) ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE AUTHOR(S) BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Service Manager cache module
+
+Defines the cache used by the Service Manager Agent
+for keeping the results of service status requests.
+
+"""
+
+import copy
+import threading
+
+from time import time
+from collections import OrderedDict
+
+class StatusCache(object):
+    """
+    Status Cache class
+
+    Keeps the results of service status requests for a limited
+    amount of time. The cache holds a limited number of entries,
+    evicting the least recently used entry when it is full.
+
+    The cache is safe for use by the workers of the worker pool.
+
+    """
+    def __init__(self, ttl, size):
+        """
+        Initializes a new StatusCache object
+
+        Args:
+            ttl  (float): Number of seconds an entry is valid for
+            size   (int): Maximum number of entries in the cache
+
+        """
+        self.ttl     = ttl
+        self.size    = size
+        self.entries = OrderedDict()
+        self.lock    = threading.Lock()
+
+    def get(self, service):
+        """
+        Get the cached status result of a service
+
+        Args:
+            service (str): Name of the service
+
+        Returns:
+            A tuple of a copy of the cached result and its age in
+            seconds, or None if there is no valid entry for the service
+
+        """
+        with self.lock:
+            entry = self.entries.pop(service, None)
+
+            if entry is None:
+                return None
+
+            created, result = entry
+            age = time() - created
+
+            if age > self.ttl:
+                return None
+
+            # Mark the entry as the most recently used one
+            self.entries[service] = entry
+
+        return (copy.deepcopy(result), age)
+
+    def put(self, service, result):
+        """
+        Adds the status result of a service to the cache
+
+        Args:
+            service  (str): Name of the service
+            result  (dict): The result of the status request
+
+        """
+        entry = (time(), copy.deepcopy(result))
+
+        with self.lock:
+            self.entries.pop(service, None)
+            self.entries[service] = entry
+
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, service):
+        """
+        Removes the cached status result of a service
+
+        Args:
+            service (str): Name of the service
+
+        """
+        with self.lock:
+            self.entries.pop(service, None)
+
+    def __len__(self):
+        return len(self.entries)
@@ -28,30 +28,99 @@ Service Manager Client module
 Defines classes for sending out client requests to a
 Service Manager.
 
+The ServiceManagerClient class sends out a single request at a time,
+while the ServiceManagerMultiplexClient class is able to keep
+many requests in flight over a single pair of sockets.
+
 """   
 
 import logging
+import itertools
 
 from time import time
 
 import zmq
 
+from service import codec
+from service import trace
+
 class ServiceManagerClient(object):
     """
     Service Manager Client class
 
     Defines methods for use by clients for sending out message requests.
 
+    A client keeps its own context and one socket per endpoint, which are
+    reused by subsequent requests. Call close() once the client is no
+    longer needed, or use the client as a context manager.
+
     Returns:
         The result message back to the client
         
     """
-    def __init__(self):
+    def __init__(self, codec_name=codec.JSON):
         """
         Initializes a ServiceManagerClient object
 
+        Args:
+            codec_name (str): Codec used for encoding the client messages,
+                              replies and results are decoded with any codec
+
+        """
+        self.codec = codec.get_codec(codec_name).name
+        self.zcontext = zmq.Context()
+        self.sockets = {}
+        self.preferred = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get_socket(self, endpoint):
         """
-        pass
+        Get the socket connected to an endpoint
+
+        The socket is created and connected on first use.
+
+        Args:
+            endpoint (str): The endpoint to connect to
+
+        Returns:
+            The REQ socket connected to the endpoint
+
+        """
+        if endpoint not in self.sockets:
+            zclient = self.zcontext.socket(zmq.REQ)
+            zclient.setsockopt(zmq.LINGER, 0)
+            zclient.connect(endpoint)
+            self.sockets[endpoint] = zclient
+
+        return self.sockets[endpoint]
+
+    def close_socket(self, endpoint):
+        """
+        Closes the socket connected to an endpoint
+
+        Args:
+            endpoint (str): The endpoint the socket is connected to
+
+        """
+        zclient = self.sockets.pop(endpoint, None)
+
+        if zclient is not None:
+            zclient.close()
+
+    def close(self):
+        """
+        Closes the client sockets and terminates the client context
+
+        """
+        for eachEndpoint in self.sockets.keys():
+            self.close_socket(eachEndpoint)
+
+        self.zcontext.term()
 
     def simple_request(self, msg, endpoint, retries=3, timeout=1000):
         """
@@ -67,57 +136,63 @@ class ServiceManagerClient(object):
 
             - http://zguide.zeromq.org/py:all#Client-Side-Reliability-Lazy-Pirate-Pattern
 
+        The socket connected to the endpoint is kept open for
+        subsequent requests and is only rebuilt if a request fails.
+
+        Traced messages, i.e. messages carrying a "trace" dict, are
+        stamped with the time they are sent, see the trace module.
+
+        A list of endpoints, e.g. of a high-availability pair of Service
+        Managers, may be given as well. Each retry goes to the next endpoint
+        in the list, and a reply from a passive Service Manager is retried
+        on the next endpoint right away, so that the client fails over
+        within the timeout. The endpoint which replied is kept in
+        self.endpoint and is tried first by subsequent requests.
+
         Args:
-            msg     (dict): The client message to send
-            retries  (int): Number of retries
-            timeout  (int): Timeout after that number of milliseconds
+            msg       (dict): The client message to send
+            endpoint   (str): The endpoint, or a list or comma-separated endpoints
+            retries    (int): Number of retries
+            timeout    (int): Timeout after that number of milliseconds
             
         """
+        endpoints = endpoint_list(endpoint)
+
         self.msg      = msg
-        self.endpoint = endpoint
+        self.endpoint = self.preferred.get(tuple(endpoints), endpoints[0])
         self.retries  = retries
         self.timeout  = timeout
 
-        self.zcontext = zmq.Context().instance()
-        
-        self.zclient = self.zcontext.socket(zmq.REQ)
-        self.zclient.connect(self.endpoint)
-        self.zclient.setsockopt(zmq.LINGER, 0)
-
-        self.zpoller = zmq.Poller()
-        self.zpoller.register(self.zclient, zmq.POLLIN)
-        
         result = None
         
         while self.retries > 0:
+            zclient = self.get_socket(self.endpoint)
+
             # Send our message out
-            self.zclient.send_json(self.msg)
-            
-            socks = dict(self.zpoller.poll(self.timeout))
+            trace.stamp(self.msg, 'client_sent')
+            codec.send(zclient, self.msg, self.codec)
 
             # Do we have a reply?
-            if socks.get(self.zclient) == zmq.POLLIN:
-                result = self.zclient.recv_json()
-                break
+            if zclient.poll(self.timeout) == zmq.POLLIN:
+                result, _codec = codec.recv(zclient)
+
+                if not is_passive(result) or len(endpoints) == 1:
+                    self.preferred[tuple(endpoints)] = self.endpoint
+                    break
+
+                self.retries -= 1
+                logging.warning("Service Manager at %s is passive, failing over...", self.endpoint)
             else:
                 # We didn't get a reply back from the server, let's retry
                 self.retries -= 1
                 logging.warning("Did not receive a reply, retrying...")
                 
-                # Socket is confused. Close and remove it.
-                self.zpoller.unregister(self.zclient)
-                self.zclient.close()
+                # Socket is confused. Close and remove it, it
+                # is re-established on the next attempt
+                self.close_socket(self.endpoint)
 
-                # Re-establish the connection
-                self.zclient = self.zcontext.socket(zmq.REQ)
-                self.zclient.connect(self.endpoint)
-                self.zclient.setsockopt(zmq.LINGER, 0)
-                self.zpoller.register(self.zclient, zmq.POLLIN)
-
-        # Close the socket and terminate the context
-        self.zpoller.unregister(self.zclient)
-        self.zclient.close()
-        self.zcontext.term()
+            result = None
+            self.endpoint = endpoints[(endpoints.index(self.endpoint) + 1) % len(endpoints)]
 
         # Did we have any result reply at all?
         if not result:
@@ -126,7 +201,7 @@ class ServiceManagerClient(object):
         
         return result
 
-    def wait_for_publisher_msgs(self, endpoint, topic, wait_time):
+    def wait_for_publisher_msgs(self, endpoint, topic, wait_time, expected=None):
         """
         Subscribes to an endpoint for messages with specific topic
 
@@ -135,10 +210,17 @@ class ServiceManagerClient(object):
         Service Manager Result Publisher endpoint and waits for any messages
         with the unique service request id as the topic.
 
+        Compressed output within the results is decompressed.
+
+        We stop waiting as soon as the expected number of results has
+        been received, or a message marked with "done": true arrives,
+        otherwise we wait until the wait time expires.
+
         Args:
             endpoint    (str): Endpoint we subscribe to
             topic       (str): The topic we subscribe to
             wait_time (float): Wait maximum that amount of seconds
+            expected    (int): Number of results we expect to receive
 
         Returns:
             A list of messages received by the publisher
@@ -147,13 +229,15 @@ class ServiceManagerClient(object):
         self.endpoint  = endpoint
         self.topic     = topic
         self.wait_time = wait_time
+        self.expected  = expected
 
         logging.debug('Endpoint: %s', self.endpoint)
         logging.debug('Topic: %s', self.topic)
         logging.debug('Wait time: %f seconds', self.wait_time)
+        logging.debug('Expected results: %s', self.expected)
 
-        self.zcontext = zmq.Context().instance()
         self.zclient  = self.zcontext.socket(zmq.SUB)
+        self.zclient.setsockopt(zmq.LINGER, 0)
         self.zclient.connect(self.endpoint)
         self.zclient.setsockopt(zmq.SUBSCRIBE, str(self.topic))
 
@@ -163,18 +247,528 @@ class ServiceManagerClient(object):
         self.wait_start = time()
 
         result = []
+        finished = 0
+
+        while self.expected is None or finished < self.expected:
+            remaining = self.wait_start + self.wait_time - time()
+
+            if remaining <= 0:
+                break
 
-        while (time() - self.wait_start) <= self.wait_time:
-            socks = dict(self.zpoller.poll(50))
+            socks = dict(self.zpoller.poll(remaining * 1000))
 
             if socks.get(self.zclient):
                 _topic = self.zclient.recv()
-                result.append(self.zclient.recv_json())
+                msg, _codec = codec.recv(self.zclient)
+                trace.stamp_results(msg, 'client_received')
+                result.append(codec.inflate(msg))
+
+                if msg.get('done'):
+                    break
+
+                # Chunks of streamed output and progress messages are not final results
+                if 'chunk' not in msg and 'progress' not in msg:
+                    finished += 1
 
         self.zpoller.unregister(self.zclient)
         self.zclient.close()
-        self.zcontext.term()
             
         return result
-    
-                
+
+    def stream_publisher_msgs(self, endpoint, topic, wait_time, expected=None):
+        """
+        Subscribes to an endpoint and yields messages as they arrive
+
+        Used for streaming service requests, where the Agents publish
+        chunks of output while the service request is still running.
+        Each Agent finishes its stream with a final result message,
+        which is marked with "eos": true.
+
+        Args:
+            endpoint    (str): Endpoint we subscribe to
+            topic       (str): The topic we subscribe to
+            wait_time (float): Stop if no message arrives for that amount of seconds
+            expected    (int): Stop after that number of end-of-stream messages
+
+        Yields:
+            The messages received by the publisher
+
+        """
+        logging.debug('Endpoint: %s', endpoint)
+        logging.debug('Topic: %s', topic)
+        logging.debug('Wait time: %f seconds', wait_time)
+
+        zclient = self.zcontext.socket(zmq.SUB)
+        zclient.setsockopt(zmq.LINGER, 0)
+        zclient.connect(endpoint)
+        zclient.setsockopt(zmq.SUBSCRIBE, str(topic))
+
+        zpoller = zmq.Poller()
+        zpoller.register(zclient, zmq.POLLIN)
+
+        finished = 0
+
+        try:
+            while expected is None or finished < expected:
+                socks = dict(zpoller.poll(wait_time * 1000))
+
+                # Nothing arrived within the wait time
+                if not socks.get(zclient):
+                    break
+
+                _topic = zclient.recv()
+                msg, _codec = codec.recv(zclient)
+                trace.stamp_results(msg, 'client_received')
+                msg = codec.inflate(msg)
+
+                if msg.get('eos'):
+                    finished += 1
+
+                yield msg
+
+                if msg.get('done'):
+                    break
+        finally:
+            zpoller.unregister(zclient)
+            zclient.close()
+
+    def watch_publisher_msgs(self, endpoint, topic, duration=None):
+        """
+        Subscribes to an endpoint and yields state changes of watched services
+
+        The Agents check the services they watch locally and report only
+        changes of their state, which the Service Manager publishes under
+        topics like "watch.<node>.<service>", so a quiet period costs no
+        messages at all.
+
+        Args:
+            endpoint    (str): Endpoint we subscribe to
+            topic       (str): The topic we subscribe to, e.g. "watch.<node>."
+            duration  (float): Stop after that amount of seconds, or never if None
+
+        Yields:
+            The state changes reported by the Agents
+
+        """
+        logging.debug('Endpoint: %s', endpoint)
+        logging.debug('Topic: %s', topic)
+
+        zclient = self.zcontext.socket(zmq.SUB)
+        zclient.setsockopt(zmq.LINGER, 0)
+        zclient.connect(endpoint)
+        zclient.setsockopt(zmq.SUBSCRIBE, str(topic))
+
+        zpoller = zmq.Poller()
+        zpoller.register(zclient, zmq.POLLIN)
+
+        deadline = None if duration is None else time() + duration
+
+        try:
+            while deadline is None or time() < deadline:
+                timeout = None if deadline is None else max(0, (deadline - time()) * 1000)
+                socks = dict(zpoller.poll(timeout))
+
+                if not socks.get(zclient):
+                    continue
+
+                _topic = zclient.recv()
+                msg, _codec = codec.recv(zclient)
+
+                if 'watch' in msg:
+                    yield msg['watch']
+        finally:
+            zpoller.unregister(zclient)
+            zclient.close()
+
+def endpoint_list(endpoint):
+    """
+    Get the list of endpoints of a Service Manager
+
+    Args:
+        endpoint (str): An endpoint, or a list or comma-separated endpoints
+
+    Returns:
+        A list of endpoints
+
+    """
+    if isinstance(endpoint, basestring):
+        endpoint = endpoint.split(',')
+
+    return [ e.strip() for e in endpoint if e.strip() ]
+
+def is_passive(reply):
+    """
+    Checks whether a reply was sent by a passive Service Manager
+
+    In high-availability mode the Service Manager which is not
+    active replies to clients with an error carrying its state.
+
+    Args:
+        reply (dict): The reply message
+
+    """
+    return isinstance(reply, dict) and reply.get('success') == -1 and reply.get('state') is not None
+
+def publisher_endpoint(endpoint, port):
+    """
+    Get the endpoint of the Service Manager Result Publisher
+
+    The Result Publisher runs on the same host as the Service Manager
+    frontend, but is bound to the port returned in the frontend reply.
+
+    Args:
+        endpoint (str): Endpoint of the Service Manager frontend
+        port     (int): Port of the Result Publisher
+
+    Returns:
+        The endpoint of the Result Publisher
+
+    """
+    transport = endpoint.split(':')[:2]
+    transport.append(str(port))
+
+    return ':'.join(transport)
+
+class ServiceRequest(object):
+    """
+    Service Request class
+
+    Keeps track of a single request sent by the
+    ServiceManagerMultiplexClient and the results received for it.
+
+    """
+    def __init__(self, tag, msg, deadline):
+        """
+        Initializes a new ServiceRequest object
+
+        Args:
+            tag        (str): Tag routing the frontend reply to the request
+            msg       (dict): The request message
+            deadline (float): Time after which we stop waiting for results
+
+        """
+        self.tag      = tag
+        self.msg      = msg
+        self.deadline = deadline
+        self.uuid     = None
+        self.expected = None
+        self.error    = None
+        self.retries  = 0
+        self.done     = False
+        self.results  = []
+        self.finished = 0
+
+    def add(self, msg):
+        """
+        Adds a message received from the Result Publisher
+
+        Args:
+            msg (dict): The received message
+
+        """
+        self.results.append(msg)
+
+        # Chunks of streamed output and progress messages are not final results
+        if 'chunk' not in msg and 'progress' not in msg:
+            self.finished += 1
+
+        if msg.get('done') or (self.expected is not None and self.finished >= self.expected):
+            self.done = True
+
+class ServiceManagerMultiplexClient(object):
+    """
+    Service Manager Multiplex Client class
+
+    Keeps many requests in flight using a single DEALER socket connected
+    to the Service Manager frontend and a single SUB socket connected to
+    the Service Manager Result Publisher.
+
+    Frontend replies are routed back to their requests by a tag, which
+    is sent along with each request, and results are routed back
+    to their requests by the service request id.
+
+    Given a list of endpoints, e.g. of a high-availability pair of
+    Service Managers, the sockets are connected to each of them and
+    requests answered by a passive Service Manager are sent again.
+
+    Example usage:
+
+        client = ServiceManagerMultiplexClient('tcp://localhost:5500')
+
+        for eachService in ('sshd', 'cron', 'ntpd'):
+            client.submit('any', eachService, 'status')
+
+        for request, msg in client.results():
+            print request.msg['service'], msg
+
+        client.close()
+
+    """
+    def __init__(self, endpoint, codec_name=codec.JSON, wait_time=5.0):
+        """
+        Initializes a new ServiceManagerMultiplexClient object
+
+        Args:
+            endpoint      (str): Endpoint of the Service Manager frontend, or
+                                 a list or comma-separated endpoints
+            codec_name    (str): Codec used for encoding the client messages
+            wait_time   (float): Default number of seconds to wait for results
+
+        """
+        self.endpoint  = endpoint
+        self.endpoints = endpoint_list(endpoint)
+        self.codec     = codec.get_codec(codec_name).name
+        self.wait_time = wait_time
+        self.tags      = itertools.count()
+        self.requests  = {}
+        self.inflight  = {}
+        self.publisher = None
+
+        self.zcontext = zmq.Context()
+
+        self.frontend = self.zcontext.socket(zmq.DEALER)
+        self.frontend.setsockopt(zmq.LINGER, 0)
+
+        # Only send requests to Service Managers we are connected to
+        self.frontend.setsockopt(zmq.IMMEDIATE, 1)
+
+        for eachEndpoint in self.endpoints:
+            self.frontend.connect(eachEndpoint)
+
+        self.subscriber = self.zcontext.socket(zmq.SUB)
+        self.subscriber.setsockopt(zmq.LINGER, 0)
+
+        self.zpoller = zmq.Poller()
+        self.zpoller.register(self.frontend, zmq.POLLIN)
+        self.zpoller.register(self.subscriber, zmq.POLLIN)
+
+    def submit(self, topic, service=None, cmd=None, wait_time=None, **kwargs):
+        """
+        Sends out a new request without waiting for its results
+
+        Args:
+            topic       (str): Topic of the message to use
+            service     (str): Name of the service to perform the operation on
+            cmd         (str): Service command, e.g. 'start', 'status', 'stop', etc.
+            wait_time (float): Wait maximum that amount of seconds for results
+
+        Any other keyword arguments are included in the request message,
+        e.g. batch=[...] for sending out a batch request, or aggregate=True
+        for letting the Service Manager aggregate the results within the wait time.
+
+        Returns:
+            A ServiceRequest object tracking the request
+
+        """
+        msg = dict(kwargs, topic=topic)
+
+        if service is not None:
+            msg['service'] = service
+
+        if cmd is not None:
+            msg['cmd'] = cmd
+
+        tag = str(next(self.tags))
+        msg['tag'] = tag
+
+        wait_time = self.wait_time if wait_time is None else wait_time
+
+        # The Service Manager publishes the aggregated results once the
+        # wait time expires, so give it some extra time to deliver them
+        if msg.get('aggregate'):
+            msg['wait_time'] = wait_time
+            wait_time += 1.0
+
+        request = ServiceRequest(tag, msg, time() + wait_time)
+        self.requests[tag] = request
+        self.send_request(request)
+
+        return request
+
+    def send_request(self, request):
+        """
+        Sends a request to the Service Manager frontend
+
+        Requests are only queued for Service Managers we are connected
+        to, so a request which cannot be sent before its wait time expires
+        means that no Service Manager is reachable, and the request fails.
+
+        Args:
+            request (ServiceRequest): The request to send
+
+        """
+        trace.stamp(request.msg, 'client_sent')
+
+        timeout = max(0, int((request.deadline - time()) * 1000))
+        self.frontend.setsockopt(zmq.SNDTIMEO, timeout)
+
+        try:
+            self.frontend.send('', zmq.SNDMORE)
+        except zmq.Again:
+            logging.error('Did not receive a reply, aborting...')
+            request.error = { 'success': -1, 'msg': 'Did not receive a reply, aborting...' }
+            self.finish(request)
+            return
+
+        codec.send(self.frontend, request.msg, self.codec)
+
+    def poll(self, timeout=None):
+        """
+        Processes any replies and results which have arrived
+
+        Args:
+            timeout (float): Wait maximum that amount of seconds for a message
+
+        Returns:
+            A list of (request, msg) tuples for the results received
+
+        """
+        events = []
+
+        socks = dict(self.zpoller.poll(None if timeout is None else timeout * 1000))
+
+        # Replies from the frontend carrying the service request ids
+        while socks.get(self.frontend) and self.frontend.poll(0):
+            _empty = self.frontend.recv()
+            reply, _codec = codec.recv(self.frontend)
+            self.process_reply(reply)
+
+        # Results from the Result Publisher
+        while socks.get(self.subscriber) and self.subscriber.poll(0):
+            topic = self.subscriber.recv()
+            msg, _codec = codec.recv(self.subscriber)
+            trace.stamp_results(msg, 'client_received')
+            request = self.inflight.get(topic)
+
+            if request is None:
+                continue
+
+            request.add(codec.inflate(msg))
+            events.append((request, msg))
+
+            if request.done:
+                self.finish(request)
+
+        self.expire()
+
+        return events
+
+    def process_reply(self, reply):
+        """
+        Processes a frontend reply for one of our requests
+
+        Args:
+            reply (dict): The reply message
+
+        """
+        request = self.requests.get(reply.get('tag'))
+
+        if request is None:
+            logging.warning('Received a reply for an unknown request: %s', reply)
+            return
+
+        # The DEALER socket sends the request to the next Service Manager
+        if is_passive(reply) and request.retries < 2 * len(self.endpoints):
+            request.retries += 1
+            self.send_request(request)
+            return
+
+        if not all(k in reply for k in ('uuid', 'port')):
+            logging.warning('Unable to acquire a service request id: %s', reply)
+            request.error = reply
+            self.finish(request)
+            return
+
+        request.uuid = reply['uuid']
+
+        # Rolling requests are complete once the final progress message arrives
+        request.expected = None if request.msg.get('rolling') else reply.get('expected')
+
+        if self.publisher is None:
+            self.publisher = [ publisher_endpoint(e, reply['port']) for e in self.endpoints ]
+
+            for eachPublisher in self.publisher:
+                self.subscriber.connect(eachPublisher)
+
+        self.inflight[str(request.uuid)] = request
+        self.subscriber.setsockopt(zmq.SUBSCRIBE, str(request.uuid))
+
+        if request.expected == 0:
+            self.finish(request)
+
+    def finish(self, request):
+        """
+        Marks a request as complete
+
+        Args:
+            request (ServiceRequest): The completed request
+
+        """
+        request.done = True
+        self.requests.pop(request.tag, None)
+
+        if request.uuid is not None and self.inflight.pop(str(request.uuid), None):
+            self.subscriber.setsockopt(zmq.UNSUBSCRIBE, str(request.uuid))
+
+    def expire(self):
+        """
+        Completes any requests whose wait time has expired
+
+        """
+        now = time()
+
+        for eachRequest in self.requests.values():
+            if eachRequest.deadline > now:
+                continue
+
+            if eachRequest.uuid is None:
+                eachRequest.error = { 'success': -1, 'msg': 'Did not receive a reply, aborting...' }
+
+            self.finish(eachRequest)
+
+    def results(self):
+        """
+        Yields results as they arrive until every request is complete
+
+        Yields:
+            A (request, msg) tuple for each result received
+
+        """
+        while self.requests:
+            deadline = min(r.deadline for r in self.requests.values())
+
+            for eachEvent in self.poll(max(0, deadline - time())):
+                yield eachEvent
+
+    def request(self, topic, service=None, cmd=None, wait_time=None, **kwargs):
+        """
+        Sends out a request and waits for its results
+
+        Other requests in flight are processed while waiting.
+
+        Returns:
+            A list of messages received by the publisher
+
+        """
+        request = self.submit(topic, service, cmd, wait_time, **kwargs)
+
+        while not request.done:
+            self.poll(max(0, request.deadline - time()))
+
+        if request.error:
+            return request.error
+
+        return request.results
+
+    def close(self):
+        """
+        Closes the client sockets
+
+        """
+        self.zpoller.unregister(self.frontend)
+        self.zpoller.unregister(self.subscriber)
+
+        self.frontend.close()
+        self.subscriber.close()
+        self.zcontext.term()
+
@@ -0,0 +1,362 @@
+# Copyright (c) 2014 Marin Atanasov Nikolov <dnaeon@gmail.com>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer
+#    in this position and unchanged.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR(S) ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE AUTHOR(S) BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Service Manager codec module
+
+Defines the codecs used for encoding the messages exchanged
+between clients, the Service Manager and the Service Manager Agents.
+
+Frames encoded with a codec other than JSON start with a codec byte
+identifying the codec of the frame. JSON frames are sent without a codec
+byte, so that they remain compatible with peers which only speak JSON.
+A frame which does not start with a known codec byte is decoded as JSON.
+
+The module also defines helpers for compressing the output
+of service requests within the result messages.
+
+"""
+
+import json
+import zlib
+import base64
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import lz4.frame as lz4frame
+except ImportError:
+    lz4frame = None
+
+from service.core import ServiceManagerException
+
+JSON    = 'json'
+MSGPACK = 'msgpack'
+
+class JSONCodec(object):
+    """
+    JSON codec class
+
+    """
+    name = JSON
+    marker = ''
+
+    def dumps(self, obj):
+        return json.dumps(obj)
+
+    def loads(self, data):
+        return json.loads(data)
+
+class MsgpackCodec(object):
+    """
+    MessagePack codec class
+
+    Requires the msgpack module to be installed
+
+    """
+    name = MSGPACK
+    marker = '\x01'
+
+    def dumps(self, obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def loads(self, data):
+        try:
+            return msgpack.unpackb(data, raw=False)
+        except TypeError:
+            # Older versions of msgpack
+            return msgpack.unpackb(data, encoding='utf-8')
+
+codecs = {
+    JSON: JSONCodec(),
+}
+
+if msgpack is not None:
+    codecs[MSGPACK] = MsgpackCodec()
+
+# Codec bytes of the frames, which are not sent as plain JSON
+markers = {
+    MsgpackCodec.marker: MSGPACK,
+}
+
+def get_codec(name):
+    """
+    Get a codec by name
+
+    Args:
+        name (str): Name of the codec, e.g. 'json' or 'msgpack'
+
+    Raises:
+        ServiceManagerException if the codec is unknown or not available
+
+    """
+    if name not in codecs:
+        raise ServiceManagerException, 'Codec %s is unknown or not available' % name
+
+    return codecs[name]
+
+def encode(obj, name=JSON):
+    """
+    Encodes a message
+
+    Args:
+        obj      (dict): The message to encode
+        name      (str): Name of the codec to use
+
+    Returns:
+        The encoded frame
+
+    """
+    c = get_codec(name)
+
+    return c.marker + c.dumps(obj)
+
+def decode(frame):
+    """
+    Decodes a message
+
+    Args:
+        frame (str): The frame to decode
+
+    Returns:
+        A tuple of the decoded message and the name of its codec
+
+    Raises:
+        ServiceManagerException if the codec of the frame is not available
+
+    """
+    name = markers.get(frame[:1])
+
+    if name is None:
+        return (codecs[JSON].loads(frame), JSON)
+
+    return (get_codec(name).loads(frame[1:]), name)
+
+def send(socket, obj, name=JSON, flags=0):
+    """
+    Encodes a message and sends it on a socket
+
+    Args:
+        socket (zmq.Socket): The socket to send the message on
+        obj          (dict): The message to send
+        name          (str): Name of the codec to use
+        flags         (int): Flags passed to the socket
+
+    """
+    socket.send(encode(obj, name), flags)
+
+def recv(socket, flags=0):
+    """
+    Receives a message from a socket and decodes it
+
+    Args:
+        socket (zmq.Socket): The socket to receive the message from
+        flags         (int): Flags passed to the socket
+
+    Returns:
+        A tuple of the decoded message and the name of its codec
+
+    """
+    return decode(socket.recv(flags))
+
+# Kinds of the messages sent to the sink of the Service Manager
+RESULT    = 'result'
+TRACED    = 'traced'
+CHUNK     = 'chunk'
+WATCH     = 'watch'
+HEARTBEAT = 'heartbeat'
+RELAY     = 'relay'
+RELAYED   = 'relayed'
+
+def envelope(kind, obj, name=JSON):
+    """
+    Encodes a message sent to the sink of the Service Manager
+
+    The encoded message is preceded by its kind and the service request
+    id, so that the Service Manager can route the message without
+    decoding it. Results carrying a trace are of the "traced" kind.
+
+        Frame 1: [ N ][...] <- Kind of the message, e.g. "result"
+        Frame 2: [ N ][...] <- The service request id, if any
+        Frame 3: [ N ][...] <- The encoded message
+
+    Args:
+        kind  (str): Kind of the message
+        obj  (dict): The message to encode
+        name  (str): Name of the codec to use
+
+    Returns:
+        A list of the frames of the message
+
+    """
+    return [ kind, str(obj.get('uuid', '')), encode(obj, name) ]
+
+# Compression methods available for the output of service requests
+compressors = {
+    'zlib': (zlib.compress, zlib.decompress),
+}
+
+if lz4frame is not None:
+    compressors['lz4'] = (lz4frame.compress, lz4frame.decompress)
+
+def compress_output(result, threshold, method='zlib', name=JSON):
+    """
+    Compresses the output of a service request result
+
+    The stdout and stderr of the result are compressed if their size
+    is at least the threshold size. A compressed output is replaced
+    by a dict describing how it was compressed, e.g.
+
+        {
+            "compression": "zlib",
+            "encoding":    "base64",
+            "data":        "<compressed-output>",
+        }
+
+    The compressed data is base64 encoded, unless the result
+    is encoded with a codec supporting binary data.
+
+    Args:
+        result     (dict): The result of the service request
+        threshold   (int): Minimum size of the output to compress
+        method      (str): The compression method to use
+        name        (str): Name of the codec the result is encoded with
+
+    Returns:
+        The result with its output compressed
+
+    """
+    compress, _decompress = compressors[method]
+
+    for k in ('stdout', 'stderr'):
+        if not isinstance(result.get(k), list):
+            continue
+
+        output = '\n'.join(result[k])
+
+        if len(output) < threshold:
+            continue
+
+        if isinstance(output, unicode):
+            output = output.encode('utf-8')
+
+        data = compress(output)
+
+        if name == JSON:
+            result[k] = { 'compression': method, 'encoding': 'base64', 'data': base64.b64encode(data) }
+        else:
+            result[k] = { 'compression': method, 'data': data }
+
+    return result
+
+def decompress_output(result):
+    """
+    Decompresses the output of a service request result
+
+    Args:
+        result (dict): The result of the service request
+
+    Returns:
+        The result with its output decompressed
+
+    Raises:
+        ServiceManagerException if the compression method is not available
+
+    """
+    for k in ('stdout', 'stderr'):
+        output = result.get(k)
+
+        if not isinstance(output, dict) or 'compression' not in output:
+            continue
+
+        if output['compression'] not in compressors:
+            raise ServiceManagerException, 'Compression %s is not available' % output['compression']
+
+        _compress, decompress = compressors[output['compression']]
+
+        data = output['data']
+
+        if output.get('encoding') == 'base64':
+            data = base64.b64decode(data)
+
+        result[k] = decompress(data).split('\n')
+
+    return result
+
+def deflate(msg, threshold, method='zlib', name=JSON):
+    """
+    Compresses the output of every result within a result message
+
+    Args:
+        msg        (dict): The result message
+        threshold   (int): Minimum size of the output to compress
+        method      (str): The compression method to use
+        name        (str): Name of the codec the message is encoded with
+
+    Returns:
+        The result message with its output compressed
+
+    """
+    result = msg.get('result')
+
+    if not isinstance(result, dict):
+        return msg
+
+    compress_output(result, threshold, method, name)
+
+    # Results of a batch request
+    for eachResult in result.get('results', []):
+        if isinstance(eachResult, dict):
+            deflate(eachResult, threshold, method, name)
+
+    return msg
+
+def inflate(msg):
+    """
+    Decompresses the output of every result within a result message
+
+    Args:
+        msg (dict): The result message
+
+    Returns:
+        The result message with its output decompressed
+
+    """
+    result = msg.get('result')
+
+    if not isinstance(result, dict):
+        return msg
+
+    decompress_output(result)
+
+    # Results of a batch request or an aggregated request
+    for eachResult in result.get('results', []):
+        if isinstance(eachResult, dict):
+            inflate(eachResult)
+
+    return msg
@@ -75,9 +75,10 @@ Workflow explained:
  (3) Client subscribes to the Service Manager Result Publisher
      and listens for topics with the acquired service request id
 
- (4) The Service Manager distributes the client service request
-     to each connected node via the XPUB socket and passes the
-     service request id along with the message
+ (4) Once the client has subscribed for results, the Service Manager
+     distributes the client service request to each connected node
+     via the XPUB socket and passes the service request id along
+     with the message
 
  (5) Each connected node receives the message via it's SUB socket
      and processes the client request
@@ -98,10 +99,44 @@ Workflow explained:
 
 """
 
+import os
+import select
+import signal
 import logging
 import platform
+import threading
 import subprocess
 
+from time import time, sleep
+
+from service.stats import metric
+
+# Seconds between checks whether a service request was cancelled
+CANCEL_POLL_INTERVAL = 0.1
+
+# Seconds before the first check whether a service(8) command has exited,
+# doubled after each check up to CANCEL_POLL_INTERVAL
+EXIT_POLL_INTERVAL = 0.001
+
+# Seconds a service(8) command is given to exit before it is killed
+KILL_GRACE_PERIOD = 1.0
+
+def dir_mtime(path):
+    """
+    Get the modification time of a directory
+
+    Args:
+        path (str): Path to the directory
+
+    Returns:
+        The modification time, or None if the directory does not exist
+
+    """
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
 class ServiceManagerException(Exception):
     """
     Generic Service Manager Exception
@@ -109,6 +144,104 @@ class ServiceManagerException(Exception):
     """
     pass
 
+class ServiceResolver(object):
+    """
+    Service Resolver class
+
+    Determines the location of the local service(8) manager and
+    caches it along with the facts about the host, so that they
+    are not looked up again on every service request.
+
+    The cached location is refreshed when the service(8)
+    executable changes or disappears, or when requested explicitly.
+    If service(8) cannot be found, the location is resolved again
+    only once one of the searched directories changes.
+
+    """
+    # Locations searched in addition to $PATH, as
+    # daemons are often started with a minimal environment
+    search_path = (
+        '/usr/sbin',
+        '/sbin',
+        '/usr/bin',
+        '/bin',
+        '/usr/local/sbin',
+        '/usr/local/bin',
+    )
+
+    def __init__(self):
+        """
+        Initializes a new ServiceResolver object
+
+        """
+        self.lock = threading.Lock()
+        self.refresh()
+
+    def refresh(self):
+        """
+        Resolves the service(8) location and the host facts
+
+        """
+        with self.lock:
+            self.system  = platform.system()
+            self.node    = platform.node()
+            self.version = platform.version()
+
+        self.resolve()
+
+    def resolve(self):
+        """
+        Resolves the service(8) location
+
+        The modification times of the searched directories are
+        remembered, so that a missing service(8) is looked up
+        again only once it may have been installed.
+
+        """
+        with self.lock:
+            self.path  = None
+            self.mtime = None
+            self.dirs  = {}
+
+            paths = os.environ.get('PATH', '').split(os.pathsep)
+            paths.extend(self.search_path)
+
+            for eachPath in paths:
+                candidate = os.path.join(eachPath, 'service')
+
+                if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+                    self.path  = candidate
+                    self.mtime = os.stat(candidate).st_mtime
+                    break
+
+                self.dirs[eachPath] = dir_mtime(eachPath)
+
+        logging.debug('Resolved service(8) location: %s', self.path)
+
+    def service_cmd(self):
+        """
+        Get the location of the local service(8) manager
+
+        Returns:
+            The path to service(8) or None if it cannot be found
+
+        """
+        if self.path is None:
+            if any(dir_mtime(d) != mtime for d, mtime in self.dirs.items()):
+                self.resolve()
+
+            return self.path
+
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            mtime = None
+
+        if mtime != self.mtime:
+            self.resolve()
+
+        return self.path
+
 class Service(object):
     """
     Service class
@@ -116,60 +249,104 @@ class Service(object):
     Defines methods for managing services via service(8)
 
     """
-    def __init__(self, name):
+    def __init__(self, name, resolver=None, stats=None):
         """
         Initializes a new Service object
         
         Args:
-            name (str): The name of the service 
+            name                  (str): The name of the service 
+            resolver  (ServiceResolver): Resolver to use for locating service(8)
+            stats               (Stats): Stats to record executed commands in
 
         """
         self.service_name = name
-        self.system = platform.system()
-        self.node = platform.node()
-        self.version = platform.version()
+        self.resolver = resolver if resolver else ServiceResolver()
+        self.stats = stats
+        self.system = self.resolver.system
+        self.node = self.resolver.node
+        self.version = self.resolver.version
 
-        # Try to determine the path to the local service(8) manager
-        p = subprocess.Popen(
-            ['which', 'service'],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        )
-
-        self.service_cmd = p.stdout.read().strip()
-
-    def run_cmd(self, cmd):
+    def run_cmd(self, cmd, stream=None, timeout=None, cancelled=None):
         """
         Execute a service command request
 
+        The output of service(8) is read while the command is running.
+        If a stream callback is given it is called with the name of the
+        stream, e.g. 'stdout' or 'stderr', and each chunk of output
+        as soon as it becomes available.
+
+        service(8) runs in a process group of its own. If it does not
+        complete within the timeout, or the cancelled event is set, the
+        whole process group is killed and the result is marked with
+        "timeout": true or "cancelled": true respectively.
+
+        The number of executed commands, failed commands and the
+        execution time are recorded per command, if stats are given.
+
         Args:
-            cmd (str): The command to pass to service(8)
+            cmd                 (str): The command to pass to service(8)
+            stream         (callable): Callback receiving chunks of output
+            timeout           (float): Seconds to wait for the command to complete
+            cancelled (threading.Event): Event set when the request is cancelled
 
         Returns:
             The result of the service(8) operation
 
         """
+        start = time()
+        deadline = start + timeout if timeout else None
+        service_cmd = self.resolver.service_cmd()
+
         logging.debug(
             'Executing service request: %s %s %s',
-            self.service_cmd,
+            service_cmd,
             self.service_name,
             cmd
         )
 
-        if not self.service_cmd:
+        if not service_cmd:
+            self.record(cmd, start, failed=True)
+
             return {
                 'success': -1,
                 'msg': 'Unable to determine location to service(8)',
                 'node': self.node
             }
 
+        # Requests cancelled while waiting for a worker are not executed
+        if cancelled is not None and cancelled.is_set():
+            return {
+                'msg': 'Service %s request was cancelled' % cmd,
+                'result': {
+                    'node':         self.node,
+                    'service':      self.service_name,
+                    'returncode':   None,
+                    'stdout':       [ '' ],
+                    'stderr':       [ '' ],
+                    'system':       self.system,
+                    'version':      self.version,
+                    'cancelled':    True,
+                }
+            }
+
         p = subprocess.Popen(
-            [self.service_cmd, self.service_name, cmd],
+            [service_cmd, self.service_name, cmd],
             stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
+            stderr=subprocess.PIPE,
+            preexec_fn=os.setsid
         )
 
-        p.wait()
+        output = self.read_output(p, stream, deadline, cancelled)
+        aborted = self.wait(p, deadline, cancelled)
+
+        if aborted:
+            logging.warning('Killing service request: %s %s %s (%s)', service_cmd, self.service_name, cmd, aborted)
+            self.kill(p)
+
+            if self.stats is not None:
+                self.stats.incr(metric('commands_aborted_total', cmd=cmd, reason=aborted))
+
+        self.record(cmd, start, failed=p.returncode != 0)
         
         result = {
             'msg': 'Executed service %s request' % cmd,
@@ -177,12 +354,183 @@ class Service(object):
                 'node':         self.node,
                 'service':      self.service_name,
                 'returncode':   p.returncode,
-                'stdout':       p.stdout.read().split('\n'),
-                'stderr':       p.stderr.read().split('\n'),
+                'stdout':       output['stdout'].split('\n'),
+                'stderr':       output['stderr'].split('\n'),
                 'system':       self.system,
                 'version':      self.version,
             }
         }
 
+        if aborted == 'timeout':
+            result['msg'] = 'Service %s request timed out after %s seconds' % (cmd, timeout)
+            result['result']['timeout'] = True
+        elif aborted == 'cancelled':
+            result['msg'] = 'Service %s request was cancelled' % cmd
+            result['result']['cancelled'] = True
+
         return result
 
+    def read_output(self, p, stream=None, deadline=None, cancelled=None):
+        """
+        Reads the output of a running service(8) command
+
+        Both stdout and stderr are read as data arrives, so that
+        a command producing a lot of output cannot block on a full pipe.
+
+        Reading stops early once the deadline passes or the
+        cancelled event is set.
+
+        Args:
+            p             (subprocess.Popen): The running service(8) command
+            stream                (callable): Callback receiving chunks of output
+            deadline                 (float): Time to stop reading at
+            cancelled      (threading.Event): Event set when the request is cancelled
+
+        Returns:
+            A dict with the collected stdout and stderr of the command
+
+        """
+        pipes = {
+            p.stdout.fileno(): ('stdout', p.stdout),
+            p.stderr.fileno(): ('stderr', p.stderr),
+        }
+
+        output = { 'stdout': [], 'stderr': [] }
+
+        while pipes:
+            if self.aborted(deadline, cancelled):
+                for _name, pipe in pipes.values():
+                    pipe.close()
+                break
+
+            wait = max(deadline - time(), 0) if deadline is not None else None
+
+            if cancelled is not None:
+                wait = CANCEL_POLL_INTERVAL if wait is None else min(wait, CANCEL_POLL_INTERVAL)
+
+            ready, _, _ = select.select(pipes.keys(), [], [], wait)
+
+            for fd in ready:
+                name, pipe = pipes[fd]
+                data = os.read(fd, 4096)
+
+                if not data:
+                    pipe.close()
+                    del pipes[fd]
+                    continue
+
+                output[name].append(data)
+
+                if stream:
+                    stream(name, data)
+
+        return dict((k, ''.join(v)) for k, v in output.items())
+
+    def aborted(self, deadline=None, cancelled=None):
+        """
+        Checks whether a service(8) command should be aborted
+
+        Args:
+            deadline               (float): Time the command should complete by
+            cancelled    (threading.Event): Event set when the request is cancelled
+
+        Returns:
+            'cancelled' or 'timeout' if the command should be aborted, None otherwise
+
+        """
+        if cancelled is not None and cancelled.is_set():
+            return 'cancelled'
+
+        if deadline is not None and time() >= deadline:
+            return 'timeout'
+
+        return None
+
+    def wait(self, p, deadline=None, cancelled=None):
+        """
+        Waits for a service(8) command to exit
+
+        Args:
+            p           (subprocess.Popen): The running service(8) command
+            deadline               (float): Time the command should complete by
+            cancelled    (threading.Event): Event set when the request is cancelled
+
+        Most commands exit right after closing their output, so the
+        command is polled with a short interval at first, which grows
+        up to CANCEL_POLL_INTERVAL for commands that keep running.
+
+        Returns:
+            The reason the command should be aborted for, see
+            aborted(), or None if the command exited in time
+
+        """
+        if deadline is None and cancelled is None:
+            p.wait()
+            return None
+
+        interval = EXIT_POLL_INTERVAL
+
+        while p.poll() is None:
+            reason = self.aborted(deadline, cancelled)
+
+            if reason:
+                return reason
+
+            wait = interval if deadline is None else min(interval, max(deadline - time(), 0))
+
+            if cancelled is not None:
+                cancelled.wait(wait)
+            else:
+                sleep(wait)
+
+            interval = min(interval * 2, CANCEL_POLL_INTERVAL)
+
+        return None
+
+    def kill(self, p):
+        """
+        Kills a service(8) command along with any process it started
+
+        The process group of the command receives SIGTERM first and
+        SIGKILL after a grace period, so that init scripts which
+        ignore SIGTERM are killed as well.
+
+        Args:
+            p (subprocess.Popen): The running service(8) command
+
+        """
+        try:
+            os.killpg(p.pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+        grace = time() + KILL_GRACE_PERIOD
+
+        while p.poll() is None and time() < grace:
+            sleep(CANCEL_POLL_INTERVAL)
+
+        try:
+            os.killpg(p.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+        p.wait()
+
+    def record(self, cmd, start, failed):
+        """
+        Records an executed command in the stats
+
+        Args:
+            cmd      (str): The command passed to service(8)
+            start  (float): Time the command was started at
+            failed  (bool): Whether the command failed
+
+        """
+        if self.stats is None:
+            return
+
+        self.stats.incr(metric('commands_total', cmd=cmd))
+        self.stats.observe(metric('command_seconds', cmd=cmd), time() - start)
+
+        if failed:
+            self.stats.incr(metric('command_errors_total', cmd=cmd))
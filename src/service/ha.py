@@ -0,0 +1,167 @@
+# Copyright (c) 2014 Marin Atanasov Nikolov <dnaeon@gmail.com>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer
+#    in this position and unchanged.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR(S) ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE AUTHOR(S) BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Service Manager high-availability module
+
+Defines the Binary Star state machine used by a pair of
+Service Managers for deciding which of them is active.
+
+Based on the Binary Star Pattern:
+
+    - http://zguide.zeromq.org/py:all#High-Availability-Pair-Binary-Star-Pattern
+
+"""
+
+import logging
+
+from time import time
+
+from service.core import ServiceManagerException
+
+# Roles of the Service Managers in a pair
+PRIMARY = 'primary'
+BACKUP  = 'backup'
+
+# States of a Service Manager, which are also sent as heartbeats
+STATE_PRIMARY = 'primary'
+STATE_BACKUP  = 'backup'
+STATE_ACTIVE  = 'active'
+STATE_PASSIVE = 'passive'
+
+STATES = (STATE_PRIMARY, STATE_BACKUP, STATE_ACTIVE, STATE_PASSIVE)
+
+class BinaryStar(object):
+    """
+    Binary Star class
+
+    A Service Manager starts in the state of its role, i.e. primary or
+    backup, and becomes active or passive depending on the state of its
+    peer, which it learns from the heartbeats the peer sends.
+
+    The primary becomes active once it learns the peer is a backup,
+    or as soon as a client request arrives and no heartbeat was received
+    from the peer recently. The backup never becomes active on its own,
+    but takes over once the active peer stops sending heartbeats and
+    a client request arrives, which means that clients have failed over.
+
+    Unlike the original pattern, a pair in which both Service Managers
+    are active does not terminate. Instead the backup becomes passive.
+
+    """
+    def __init__(self, role, heartbeat):
+        """
+        Initializes a new BinaryStar object
+
+        Args:
+            role         (str): Role of the Service Manager, primary or backup
+            heartbeat  (float): Seconds between the heartbeats of the peers
+
+        """
+        if role not in (PRIMARY, BACKUP):
+            raise ServiceManagerException, 'Unknown high-availability role: %s' % role
+
+        self.role        = role
+        self.state       = STATE_PRIMARY if role == PRIMARY else STATE_BACKUP
+        self.heartbeat   = heartbeat
+        self.peer_expiry = time() + 2 * heartbeat
+
+    def is_active(self):
+        """
+        Checks whether the Service Manager is active
+
+        """
+        return self.state == STATE_ACTIVE
+
+    def peer_state(self, state):
+        """
+        Updates our state upon a heartbeat from the peer
+
+        Args:
+            state (str): The state of the peer
+
+        """
+        self.peer_expiry = time() + 2 * self.heartbeat
+
+        if state not in STATES:
+            logging.warning('Received an unknown peer state: %s', state)
+            return
+
+        if self.state == STATE_PRIMARY:
+            if state == STATE_BACKUP:
+                self.change(STATE_ACTIVE, 'connected to backup peer')
+            elif state == STATE_ACTIVE:
+                self.change(STATE_PASSIVE, 'connected to active backup peer')
+        elif self.state == STATE_BACKUP:
+            if state == STATE_ACTIVE:
+                self.change(STATE_PASSIVE, 'connected to active primary peer')
+        elif self.state == STATE_ACTIVE:
+            if state == STATE_ACTIVE:
+                logging.error('Both Service Managers of the pair are active')
+
+                if self.role == BACKUP:
+                    self.change(STATE_PASSIVE, 'primary peer is active as well')
+        elif self.state == STATE_PASSIVE:
+            if state in (STATE_PRIMARY, STATE_BACKUP):
+                self.change(STATE_ACTIVE, 'peer restarted')
+            elif state == STATE_PASSIVE:
+                logging.error('Both Service Managers of the pair are passive')
+
+                if self.role == PRIMARY:
+                    self.change(STATE_ACTIVE, 'backup peer is passive as well')
+
+    def client_request(self):
+        """
+        Updates our state upon a client request
+
+        Returns:
+            True if the client request should be served, False otherwise
+
+        """
+        if self.state == STATE_ACTIVE:
+            return True
+
+        # The backup waits for the primary to be gone before taking over
+        if self.state in (STATE_PRIMARY, STATE_PASSIVE) and time() >= self.peer_expiry:
+            self.change(STATE_ACTIVE, 'peer is not responding')
+            return True
+
+        if self.state == STATE_BACKUP and time() >= self.peer_expiry:
+            logging.warning('Backup Service Manager has not seen its peer yet')
+
+        return False
+
+    def change(self, state, reason):
+        """
+        Changes our state
+
+        Args:
+            state   (str): The new state
+            reason  (str): Reason for the change, which is logged
+
+        """
+        logging.info('Service Manager is %s (was %s): %s', state, self.state, reason)
+
+        self.state = state
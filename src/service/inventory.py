@@ -0,0 +1,243 @@
+# Copyright (c) 2014 Marin Atanasov Nikolov <dnaeon@gmail.com>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer
+#    in this position and unchanged.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR(S) ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE AUTHOR(S) BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Service Manager inventory module
+
+Defines the index of the services installed on the node
+of a Service Manager Agent.
+
+"""
+
+import os
+import logging
+import threading
+
+from time import time
+
+class ServiceInventory(object):
+    """
+    Service Inventory class
+
+    Keeps an index of the services installed on the node, built from
+    the init scripts in the init.d and rc.d directories, the upstart jobs
+    and the systemd service units, so that service requests for unknown
+    services can be answered without running service(8).
+
+    The directories are checked for changes of their modification
+    time at most once every check interval, and are scanned again
+    if any of them changed.
+
+    The inventory is safe for use by the workers of the worker pool.
+
+    """
+    # Directories scanned for services, along with the
+    # suffix of their entries, if any, which is stripped
+    directories = (
+        ('/etc/init.d', None),
+        ('/etc/rc.d', None),
+        ('/etc/rc.d/init.d', None),
+        ('/usr/local/etc/rc.d', None),
+        ('/etc/init', '.conf'),
+        ('/etc/systemd/system', '.service'),
+        ('/run/systemd/system', '.service'),
+        ('/lib/systemd/system', '.service'),
+        ('/usr/lib/systemd/system', '.service'),
+        ('/usr/local/lib/systemd/system', '.service'),
+    )
+
+    def __init__(self, interval, directories=None):
+        """
+        Initializes a new ServiceInventory object
+
+        Args:
+            interval      (float): Seconds between checks of the directories for changes
+            directories    (list): A list of (directory, suffix) tuples to scan instead of the defaults
+
+        """
+        self.interval   = interval
+        self.lock       = threading.Lock()
+        self.services   = {}
+        self.mtimes     = {}
+        self.scanned    = None
+        self.next_check = 0
+
+        if directories is not None:
+            self.directories = tuple(directories)
+
+        self.refresh()
+
+    def __len__(self):
+        return len(self.services)
+
+    def refresh(self):
+        """
+        Scans the directories for installed services
+
+        """
+        services = {}
+        mtimes = {}
+
+        for path, suffix in self.directories:
+            try:
+                mtimes[path] = os.stat(path).st_mtime
+                entries = os.listdir(path)
+            except OSError:
+                continue
+
+            for eachEntry in entries:
+                name = self.service_name(path, eachEntry, suffix)
+
+                if name is not None:
+                    services.setdefault(name, path)
+
+        with self.lock:
+            self.services   = services
+            self.mtimes     = mtimes
+            self.scanned    = time()
+            self.next_check = self.scanned + self.interval
+
+        logging.debug('Found %d services in %d directories', len(services), len(mtimes))
+
+        if not services:
+            logging.warning('No services found in %s, requests for any service are executed', ', '.join(p for p, _ in self.directories))
+
+    def service_name(self, path, entry, suffix):
+        """
+        Get the name of the service an entry of a directory provides
+
+        Args:
+            path    (str): The directory
+            entry   (str): Name of the entry in the directory
+            suffix  (str): Suffix of the entries providing services, if any
+
+        Returns:
+            The name of the service, or None if the entry does not provide one
+
+        """
+        if entry.startswith('.'):
+            return None
+
+        if suffix is not None:
+            if not entry.endswith(suffix):
+                return None
+
+            name = entry[:-len(suffix)]
+
+            return name or None
+
+        # Init scripts are executable files
+        fullpath = os.path.join(path, entry)
+
+        if not os.path.isfile(fullpath) or not os.access(fullpath, os.X_OK):
+            return None
+
+        return entry
+
+    def changed(self):
+        """
+        Checks whether any of the directories changed since the last scan
+
+        """
+        for path, _suffix in self.directories:
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                mtime = None
+
+            if mtime != self.mtimes.get(path):
+                return True
+
+        return False
+
+    def check(self):
+        """
+        Scans the directories again, if the check interval has passed and any of them changed
+
+        """
+        with self.lock:
+            if time() < self.next_check:
+                return
+
+            self.next_check = time() + self.interval
+
+        if self.changed():
+            self.refresh()
+
+    def is_enabled(self):
+        """
+        Checks whether the inventory can tell installed services apart
+
+        An inventory which found no services at all, e.g. on a node
+        using a service manager it does not know about, accepts any service.
+
+        """
+        return bool(self.services)
+
+    def contains(self, service):
+        """
+        Checks whether a service is installed
+
+        Instances of systemd template units, e.g. getty@tty1, are
+        known as long as their template unit is installed.
+
+        Args:
+            service (str): Name of the service
+
+        Returns:
+            True if the service is installed or the inventory is not enabled, False otherwise
+
+        """
+        self.check()
+
+        services = self.services
+
+        if not services or service in services:
+            return True
+
+        if service.endswith('.service'):
+            return self.contains(service[:-len('.service')])
+
+        if '@' in service:
+            return service.split('@', 1)[0] + '@' in services
+
+        return False
+
+    def snapshot(self):
+        """
+        Get the installed services along with where they were found
+
+        Returns:
+            A dict of the services, the directories and the time of the last scan
+
+        """
+        self.check()
+
+        with self.lock:
+            return {
+                'services':    dict(self.services),
+                'directories': sorted(self.mtimes),
+                'scanned':     self.scanned,
+            }
@@ -28,13 +28,113 @@ Service Manager Daemon
 """
 
 import uuid
+import heapq
 import logging
 import platform
+import threading
+
+from time import time
+from collections import OrderedDict
 
 import zmq
 
+from service import codec
+from service import trace
+from service import sockopts
 from service.core import ServiceManagerException
 from service.daemon import Daemon
+from service.ha import BinaryStar
+from service.registry import NodeRegistry
+from service.stats import Stats
+from service.stats import metric
+
+# Keys of the metrics updated for every message received
+FRONTEND_MESSAGES   = metric('messages_total', socket='frontend')
+BACKEND_MESSAGES    = metric('messages_total', socket='backend')
+SINK_MESSAGES       = metric('messages_total', socket='sink')
+RESULT_PUB_MESSAGES = metric('messages_total', socket='result_pub')
+MGMT_MESSAGES       = metric('messages_total', socket='mgmt')
+SERVICE_REQUESTS    = metric('requests_total', type='service')
+BATCH_REQUESTS      = metric('requests_total', type='batch')
+
+# Endpoint connecting the main loop and the Result Forwarder in pipeline mode
+FORWARDER_ENDPOINT = 'inproc://service-mgr-forwarder'
+
+# Topic the state changes of watched services are published under
+WATCH_TOPIC = 'watch'
+
+# Topic every Agent subscribes to, used for cancelling service requests
+ANY_TOPIC = 'any'
+
+def open_envelope(frames):
+    """
+    Get the kind, service request id and encoded message of a sink message
+
+    Messages sent by Agents which do not precede their messages with
+    the kind and the service request id, see codec.envelope(), are
+    decoded to find out about them.
+
+    Args:
+        frames (list): The frames received on the sink socket
+
+    Returns:
+        A (kind, req_id, frame) tuple
+
+    """
+    if len(frames) == 3:
+        return tuple(frames)
+
+    frame = frames[-1]
+    msg, _name = codec.decode(frame)
+
+    for kind in (codec.RELAY, codec.RELAYED, codec.WATCH, codec.HEARTBEAT, codec.CHUNK):
+        if kind in msg:
+            break
+    else:
+        kind = codec.TRACED if 'trace' in msg else codec.RESULT
+
+    return (kind, str(msg.get('uuid', '')), frame)
+
+def collect_result(kind, frame):
+    """
+    Prepares a message received on the sink socket for publishing
+
+    Traced results are stamped with the time they were collected
+    and encoded again, other messages are left as they are,
+    without decoding them.
+
+    Args:
+        kind   (str): Kind of the message, see codec.envelope()
+        frame  (str): The encoded message
+
+    Returns:
+        The message as it should be published
+
+    """
+    if kind != codec.TRACED:
+        return frame
+
+    msg, name = codec.decode(frame)
+    trace.stamp(msg, 'manager_collected')
+
+    return codec.encode(msg, name)
+
+def watch_topic(event):
+    """
+    Get the topic a state change of a watched service is published under
+
+    The topic looks like "watch.<node>.<service>", so that clients can
+    subscribe to the state changes of all nodes, a single node or a
+    single service on a node.
+
+    Args:
+        event (dict): The state change reported by an Agent
+
+    Returns:
+        The topic of the state change
+
+    """
+    return '%s.%s.%s' % (WATCH_TOPIC, event.get('node', ''), event.get('service', ''))
 
 class ServiceManager(Daemon):
     """
@@ -51,6 +151,12 @@ class ServiceManager(Daemon):
         """
         Main daemon method 
 
+        In pipeline mode the results of the Agents are forwarded from the
+        sink socket to the Result Publisher socket on a thread of its own,
+        see ResultForwarder, so that a burst of large results does not
+        delay the replies to new clients. The main loop and the Result
+        Forwarder are connected by an inproc socket.
+
         """
         # A flag to indicate that our daemon should terminate
         self.time_to_die = False
@@ -60,9 +166,104 @@ class ServiceManager(Daemon):
 
         logging.info('Service Manager started')
 
+        # Number of Agents subscribed to each topic
+        self.subscriptions = {}
+
+        # Service requests waiting for their clients to subscribe
+        # for results, ordered by the time they expire
+        self.pending = OrderedDict()
+        self.subscribe_timeout = float(kwargs.get('subscribe_timeout', 1.0))
+
+        # Codec used for the service requests sent to the Agents
+        self.backend_codec = codec.get_codec(kwargs.get('backend_codec', codec.JSON)).name
+
+        # Service requests in aggregate mode, along with a heap
+        # of their deadlines ordered by the time they expire
+        self.aggregates = {}
+        self.aggregate_timers = []
+        self.aggregate_timeout = float(kwargs.get('aggregate_timeout', 5.0))
+
+        # Identical in-flight service requests for these commands are
+        # coalesced, so that later clients share the first request's results
+        self.coalesce_cmds = set(c.strip() for c in kwargs.get('coalesce_cmds', '').split(',') if c.strip())
+        self.coalesce_window = float(kwargs.get('coalesce_window', 1.0))
+        self.coalesce_timeout = float(kwargs.get('coalesce_timeout', 60.0))
+
+        # Coalesced requests which clients may attach to by request key and
+        # by request id, the request ids of attached clients, and a heap of
+        # the deadlines of coalesced requests ordered by the time they expire
+        self.coalescing = {}
+        self.coalesced = {}
+        self.followers = {}
+        self.coalesce_timers = []
+
+        # Service requests executed in waves of nodes
+        self.rollouts = {}
+        self.rolling_timeout = float(kwargs.get('rolling_timeout', 60.0))
+
+        # Agents which are alive, i.e. which sent a heartbeat recently
+        self.registry = NodeRegistry(int(kwargs.get('heartbeat_liveness', 3)))
+
+        # Runtime metrics, which are optionally dumped to a file
+        # in the Prometheus text format every stats interval
+        self.stats = Stats('service_mgr')
+        self.stats.gauge('pending_requests', lambda: len(self.pending))
+        self.stats.gauge('aggregates', lambda: len(self.aggregates))
+        self.stats.gauge('coalesced_requests', lambda: len(self.coalesced))
+        self.stats.gauge('subscriptions', lambda: sum(self.subscriptions.values()))
+        self.stats.gauge('nodes', lambda: len(self.registry))
+        self.stats.gauge('agent_dropped_requests', self.registry.dropped)
+        self.stats_file = kwargs.get('stats_file')
+        self.stats_interval = float(kwargs.get('stats_interval', 10.0))
+        self.stats_next = time()
+
+        # Subscriptions reported by the relays connected to us, i.e.
+        # Service Managers relaying our service requests to their Agents
+        self.relays = {}
+
+        # In relay mode we forward the service requests of an upstream
+        # Service Manager to our Agents and send back their merged results
+        self.relay = 'upstream_backend_endpoint' in kwargs or 'upstream_sink_endpoint' in kwargs
+        self.relay_timeout = float(kwargs.get('relay_timeout', 5.0))
+        self.relay_interval = float(kwargs.get('relay_interval', 10.0))
+        self.relayed = {}
+        self.relay_timers = []
+
+        if self.relay:
+            self.create_upstream_sockets(**kwargs)
+
+        # In high-availability mode only the active Service Manager
+        # of a pair serves client requests, see the ha module
+        self.ha = None
+
+        if 'ha_role' in kwargs:
+            self.create_peer_sockets(**kwargs)
+
+        # Forward results on a thread of its own
+        self.pipeline = kwargs.get('pipeline', 'no').lower() in ('1', 'yes', 'true', 'on')
+
+        # The sink and Result Publisher sockets are handed over to the
+        # Result Forwarder, which talks to us over the forwarder socket
+        if self.pipeline:
+            self.zpoller.unregister(self.sink_socket)
+            self.zpoller.unregister(self.result_pub_socket)
+
+            self.forwarder_socket = self.zcontext.socket(zmq.PAIR)
+            self.forwarder_socket.bind(FORWARDER_ENDPOINT)
+            self.zpoller.register(self.forwarder_socket, zmq.POLLIN)
+
+            self.forwarder = ResultForwarder(
+                zcontext=self.zcontext,
+                sink_socket=self.sink_socket,
+                result_pub_socket=self.result_pub_socket,
+                endpoint=FORWARDER_ENDPOINT,
+                stats=self.stats
+            )
+            self.forwarder.start()
+
         # Main daemon loop
         while not self.time_to_die:
-            socks = dict(self.zpoller.poll())
+            socks = dict(self.zpoller.poll(self.poll_timeout()))
 
             # Frontend socket, clients are requesting a service id
             if socks.get(self.frontend_socket):
@@ -75,12 +276,64 @@ class ServiceManager(Daemon):
             # Sink socket, collects results from the backend agents
             if socks.get(self.sink_socket):
                 self.process_sink_msg()
+
+            # Result publisher socket, clients are subscribing for results
+            if socks.get(self.result_pub_socket):
+                self.process_result_pub_msg()
+
+            # Forwarder socket, subscriptions and results from the Result Forwarder
+            if self.pipeline and socks.get(self.forwarder_socket):
+                self.process_forwarder_msg()
+
+            # Upstream socket, service requests from the upstream Service Manager
+            if self.relay and socks.get(self.upstream_socket):
+                self.process_upstream_msg()
+
+            # Peer socket, heartbeats from our high-availability peer
+            if self.ha and socks.get(self.peer_sub_socket):
+                self.process_peer_msg()
+
+            # Let our high-availability peer know we are alive
+            self.send_heartbeat()
+
+            # Send back merged results whose relay timeout expired
+            self.relay_expired()
+
+            # Dispatch requests whose clients did not subscribe in time
+            self.dispatch_expired()
+
+            # Publish aggregated results whose deadline has been reached
+            self.publish_expired()
+
+            # Forget coalesced requests whose results are no longer expected
+            self.coalesce_expired()
+
+            # Forget Agents which missed their heartbeats
+            self.registry.expire()
+
+            # Dispatch the next waves of rolling requests
+            self.rolling_expired()
+
+            # Dump the metrics if the stats interval has passed
+            self.dump_stats()
   
             # Management socket, receives management commands
             if socks.get(self.mgmt_socket):
                 self.process_mgmt_msg()
 
         # Shutdown time has arrived, let's cleanup a bit here
+        if self.pipeline:
+            self.forwarder_socket.send_multipart(['stop'])
+            self.forwarder.join()
+            self.zpoller.unregister(self.forwarder_socket)
+            self.forwarder_socket.close()
+
+        if self.relay:
+            self.close_upstream_sockets()
+
+        if self.ha:
+            self.close_peer_sockets()
+
         self.close_listeners()
         self.stop()
 
@@ -112,15 +365,41 @@ class ServiceManager(Daemon):
         self.backend_socket    = self.zcontext.socket(zmq.XPUB)
         self.sink_socket       = self.zcontext.socket(zmq.PULL)
         self.mgmt_socket       = self.zcontext.socket(zmq.REP)
-        self.result_pub_socket = self.zcontext.socket(zmq.PUB)
+        self.result_pub_socket = self.zcontext.socket(zmq.XPUB)
+
+        # High-water marks, buffer sizes and TCP keepalive from the conf file
+        sockopts.configure(self.frontend_socket, 'frontend', kwargs)
+        sockopts.configure(self.backend_socket, 'backend', kwargs)
+        sockopts.configure(self.sink_socket, 'sink', kwargs)
+        sockopts.configure(self.mgmt_socket, 'mgmt', kwargs)
+        sockopts.configure(self.result_pub_socket, 'result_pub', kwargs)
+
+        # Sequence numbers of the messages sent on the backend socket by
+        # topic, which let Agents detect messages dropped on their way
+        self.backend_seqs = {}
+
+        # Make the backend socket pass every (un)subscription
+        # instead of only the first and last one for a topic,
+        # so that we can track the number of subscribed Agents
+        if hasattr(zmq, 'XPUB_VERBOSER'):
+            self.backend_socket.setsockopt(zmq.XPUB_VERBOSER, 1)
+        else:
+            self.backend_socket.setsockopt(zmq.XPUB_VERBOSE, 1)
 
         try:
             self.frontend_socket.bind(self.frontend_endpoint)
             self.backend_socket.bind(self.backend_endpoint)
             self.sink_socket.bind(self.sink_endpoint)
             self.mgmt_socket.bind(self.mgmt_endpoint)
-            self.result_pub_port = self.result_pub_socket.bind_to_random_port('tcp://*')
-        except zmq.ZMQError as e:
+
+            # A fixed Result Publisher endpoint lets clients reach
+            # either Service Manager of a pair on the same port
+            if hasattr(self, 'result_pub_endpoint'):
+                self.result_pub_socket.bind(self.result_pub_endpoint)
+                self.result_pub_port = int(self.result_pub_endpoint.rsplit(':', 1)[1])
+            else:
+                self.result_pub_port = self.result_pub_socket.bind_to_random_port('tcp://*')
+        except (zmq.ZMQError, ValueError) as e:
             raise ServiceManagerException, 'Cannot bind Service Manager sockets: %s' % e
 
         # Create a poll set for our sockets
@@ -129,6 +408,7 @@ class ServiceManager(Daemon):
         self.zpoller.register(self.backend_socket, zmq.POLLIN)
         self.zpoller.register(self.sink_socket, zmq.POLLIN)
         self.zpoller.register(self.mgmt_socket, zmq.POLLIN)
+        self.zpoller.register(self.result_pub_socket, zmq.POLLIN)
 
         logging.debug('Frontend socket bound to %s', self.frontend_endpoint)
         logging.debug('Backend socket bound to %s', self.backend_endpoint)
@@ -136,6 +416,96 @@ class ServiceManager(Daemon):
         logging.debug('Management socket bound to %s', self.mgmt_endpoint)
         logging.debug('Result publisher socket bound to %s', 'tcp://*:' + str(self.result_pub_port))
 
+    def create_upstream_sockets(self, **kwargs):
+        """
+        Creates the sockets connected to the upstream Service Manager
+
+        In relay mode we subscribe to the backend of the upstream Service
+        Manager on behalf of our Agents, and push their merged results
+        to the sink of the upstream Service Manager.
+
+        """
+        logging.debug('Creating Service Manager upstream sockets')
+
+        if not all(k in kwargs for k in ('upstream_backend_endpoint', 'upstream_sink_endpoint')):
+            raise ServiceManagerException, 'Missing upstream socket endpoints, e.g. upstream_backend/upstream_sink'
+
+        # Each relay identifies itself to the upstream Service Manager
+        self.relay_id = '%s-%s' % (platform.node(), uuid.uuid4().get_hex()[:8])
+        self.relay_report_next = time()
+
+        self.upstream_socket      = self.zcontext.socket(zmq.XSUB)
+        self.upstream_sink_socket = self.zcontext.socket(zmq.PUSH)
+
+        sockopts.configure(self.upstream_socket, 'upstream', kwargs)
+        sockopts.configure(self.upstream_sink_socket, 'upstream_sink', kwargs)
+
+        try:
+            self.upstream_socket.connect(self.upstream_backend_endpoint)
+            self.upstream_sink_socket.connect(self.upstream_sink_endpoint)
+        except zmq.ZMQError as e:
+            raise ServiceManagerException, 'Cannot connect to the upstream Service Manager: %s' % e
+
+        self.zpoller.register(self.upstream_socket, zmq.POLLIN)
+
+        logging.debug('Upstream socket connected to %s', self.upstream_backend_endpoint)
+        logging.debug('Upstream sink socket connected to %s', self.upstream_sink_endpoint)
+
+    def create_peer_sockets(self, **kwargs):
+        """
+        Creates the sockets used for heartbeating with our peer
+
+        The Service Managers of a pair publish their state to each
+        other every heartbeat interval, see BinaryStar for details.
+
+        """
+        logging.debug('Creating Service Manager peer sockets')
+
+        if not all(k in kwargs for k in ('ha_local_endpoint', 'ha_peer_endpoint')):
+            raise ServiceManagerException, 'Missing peer socket endpoints, e.g. ha_local/ha_peer'
+
+        self.ha = BinaryStar(kwargs['ha_role'].lower(), float(kwargs.get('ha_heartbeat', 1.0)))
+        self.ha_next = time()
+
+        self.peer_pub_socket = self.zcontext.socket(zmq.PUB)
+        self.peer_sub_socket = self.zcontext.socket(zmq.SUB)
+        self.peer_sub_socket.setsockopt(zmq.SUBSCRIBE, '')
+
+        try:
+            self.peer_pub_socket.bind(self.ha_local_endpoint)
+            self.peer_sub_socket.connect(self.ha_peer_endpoint)
+        except zmq.ZMQError as e:
+            raise ServiceManagerException, 'Cannot create peer sockets: %s' % e
+
+        self.zpoller.register(self.peer_sub_socket, zmq.POLLIN)
+
+        logging.debug('Peer publisher socket bound to %s', self.ha_local_endpoint)
+        logging.debug('Peer subscriber socket connected to %s', self.ha_peer_endpoint)
+
+    def close_peer_sockets(self):
+        """
+        Closes the sockets used for heartbeating with our peer
+
+        """
+        logging.debug('Closing Service Manager peer sockets')
+
+        self.zpoller.unregister(self.peer_sub_socket)
+
+        self.peer_pub_socket.close()
+        self.peer_sub_socket.close()
+
+    def close_upstream_sockets(self):
+        """
+        Closes the sockets connected to the upstream Service Manager
+
+        """
+        logging.debug('Closing Service Manager upstream sockets')
+
+        self.zpoller.unregister(self.upstream_socket)
+
+        self.upstream_socket.close()
+        self.upstream_sink_socket.close()
+
     def close_listeners(self):
         """
         Closes the Service Manager sockets
@@ -145,9 +515,12 @@ class ServiceManager(Daemon):
 
         self.zpoller.unregister(self.frontend_socket)
         self.zpoller.unregister(self.backend_socket)
-        self.zpoller.unregister(self.sink_socket)
         self.zpoller.unregister(self.mgmt_socket)
 
+        if not self.pipeline:
+            self.zpoller.unregister(self.sink_socket)
+            self.zpoller.unregister(self.result_pub_socket)
+
         self.frontend_socket.close()
         self.backend_socket.close()
         self.sink_socket.close()
@@ -171,7 +544,10 @@ class ServiceManager(Daemon):
         unique service request id for the clients.
 
         It is up to the client to subscribe to the Service Manager
-        Result Publisher endpoint for receiving any results.
+        Result Publisher endpoint for receiving any results. The service
+        request is dispatched to the Agents once the client has subscribed,
+        or after the subscribe timeout expires, so that results published
+        before the client subscription arrives are not lost.
 
         Example client message on the frontend socket could look like this:
         
@@ -181,171 +557,1969 @@ class ServiceManager(Daemon):
                 "topic":   "FreeBSD",
             }
 
+        A batch of service requests can be sent in a single message as well,
+        which is dispatched to the Agents at once:
+
+            {
+                "batch": [
+                    { "cmd": "status", "service": "sshd" },
+                    { "cmd": "status", "service": "cron" },
+                ],
+                "topic": "FreeBSD",
+            }
+
         The Service Manager's frontend socket replies to the client with a
         unique service request id, so that clients can subscribe for results.
+        The reply also contains the number of Agents which are expected
+        to receive the service request.
         
             {
-                "uuid": "<unique-service-request-id>",
-                "port": "<result-publisher-port>",
+                "uuid":     "<unique-service-request-id>",
+                "port":     "<result-publisher-port>",
+                "expected": "<number-of-subscribed-agents>",
+            }
+
+        The reply is encoded with the same codec as the client message,
+        and the results of the service request are published using
+        that codec as well.
+
+        If the client message contains "aggregate": true, the results from
+        the Agents are collected until every expected Agent replied or the
+        "wait_time" in seconds expires, and are then published as a single
+        aggregated message, see Aggregate.result() for details.
+
+        If the client message contains a "trace" dict, each hop of the
+        service request adds a timestamp to it, see the trace module.
+
+        In high-availability mode a Service Manager which is not active
+        replies with an error carrying its "state", so that clients can
+        fail over to its peer right away.
+
+        Clients sending "watch": true are not dispatched to the Agents.
+        Instead the reply tells them the Result Publisher port and the topic
+        the state changes of watched services are published under:
+
+            {
+                "topic": "watch",
+                "port":  "<result-publisher-port>",
+            }
+
+        Clients sending "cancel" with the id of a service request have the
+        Agents kill the service(8) commands of that request, see cancel_request():
+
+            {
+                "cancel": "<unique-service-request-id>",
+            }
+
+        The service(8) commands of a service request are killed by the
+        Agents once they run for longer than its "exec_timeout" in seconds,
+        or the "exec_timeout" in the conf file of the Agents.
+
+        If the client message contains "rolling", the service request is
+        executed on the nodes receiving the topic in waves, see RollingRequest:
+
+            {
+                "cmd":     "restart",
+                "service": "sshd",
+                "topic":   "FreeBSD",
+                "rolling": {
+                    "batch":             10,
+                    "concurrency":       10,
+                    "delay":             5.0,
+                    "max_failure_ratio": 0.1,
+                    "timeout":           60.0,
+                }
             }
 
+        Service requests for one of the commands in "coalesce_cmds" are
+        coalesced -- a request identical to one dispatched less than
+        "coalesce_window" seconds ago is not dispatched again. Instead, the
+        client is attached to the request in flight and receives its results
+        under its own service request id, see CoalescedRequest for details.
+
         """
         logging.debug('Received message on the frontend socket')
 
+        self.stats.incr(FRONTEND_MESSAGES)
+
         _id    = self.frontend_socket.recv()
         _empty = self.frontend_socket.recv()
-        msg    = self.frontend_socket.recv_json()
+
+        try:
+            msg, name = codec.recv(self.frontend_socket)
+        except (ValueError, ServiceManagerException) as e:
+            self.send_frontend_reply(_id, { 'success': -1, 'msg': 'Cannot decode request message: %s' % e })
+            return
 
         logging.debug('ID: %s', _id)
         logging.debug('Message: %s', msg)
 
         if not isinstance(msg, dict):
-            self.frontend_socket.send(_id, zmq.SNDMORE)
-            self.frontend_socket.send("", zmq.SNDMORE)
-            self.frontend_socket.send_json({ 'success': -1, 'msg': 'Request message should be in JSON format' })
+            self.send_frontend_reply(_id, { 'success': -1, 'msg': 'Request message should be in JSON format' }, name)
+            return
+
+        # Clients fail over to the other Service Manager of the pair
+        if self.ha and not self.ha.client_request():
+            self.send_frontend_reply(_id, { 'success': -1, 'msg': 'Service Manager is passive', 'state': self.ha.state }, name, msg.get('tag'))
+            return
+
+        # Clients watching services only need to know where to subscribe
+        if msg.get('watch'):
+            self.send_frontend_reply(_id, { 'topic': WATCH_TOPIC, 'port': self.result_pub_port }, name, msg.get('tag'))
+            return
+
+        if 'cancel' in msg:
+            self.send_frontend_reply(_id, self.cancel_request(msg['cancel']), name, msg.get('tag'))
+            return
+
+        if 'topic' not in msg or not ('batch' in msg or 'service' in msg):
+            self.send_frontend_reply(_id, { 'success': -1, 'msg': 'Missing message properties' }, name, msg.get('tag'))
+            return
+
+        error = self.check_request(msg)
+
+        if error:
+            self.send_frontend_reply(_id, { 'success': -1, 'msg': error }, name, msg.get('tag'))
             return
 
+        try:
+            wait_time = float(msg.get('wait_time', self.aggregate_timeout))
+        except (TypeError, ValueError):
+            self.send_frontend_reply(_id, { 'success': -1, 'msg': 'Wait time should be a number' }, name, msg.get('tag'))
+            return
+
+        rolling = None
+
+        if msg.get('rolling'):
+            try:
+                rolling = self.create_rolling(msg, name)
+            except ServiceManagerException as e:
+                self.send_frontend_reply(_id, { 'success': -1, 'msg': str(e) }, name, msg.get('tag'))
+                return
+
+        trace.stamp(msg, 'manager_received')
+
         logging.debug('Generating client id for result collecting')
 
+        # Identical service requests may share a request in flight
+        key = self.coalesce_key(msg, name)
+        leader = self.coalescing.get(key) if key else None
+
+        if leader is not None and leader.window_end <= time():
+            del self.coalescing[key]
+            leader = None
+
         # Generate a service request id for our client and ask them to
         # subscribe to the result publisher endpoint in order to receive
         # their results
         req_id = uuid.uuid4().get_hex()
-        self.frontend_socket.send(_id, zmq.SNDMORE)
-        self.frontend_socket.send("", zmq.SNDMORE)
-        self.frontend_socket.send_json({'uuid': req_id, 'port': self.result_pub_port})
+
+        if rolling is not None:
+            expected = len(rolling.targets)
+        elif leader is not None:
+            expected = leader.expected
+        else:
+            expected = self.expected_subscribers(msg['topic'])
+        self.send_frontend_reply(_id, {'uuid': req_id, 'port': self.result_pub_port, 'expected': expected}, name, msg.pop('tag', None))
         
         logging.debug('Client service request id is: %s', req_id)
+
+        # Results are replayed to attached clients once they subscribe
+        if leader is not None:
+            logging.debug('Attaching %s to coalesced request %s', req_id, leader.req_id)
+            self.stats.incr('requests_coalesced_total')
+            leader.followers[req_id] = False
+            self.followers[req_id] = leader.req_id
+            self.pending[req_id] = (time() + self.subscribe_timeout, None)
+            return
         
         # The message we send to the backend also contains the client
         # service request id as well. This is done so later when we receive
         # the results in the sink we can route the results to the clients properly
         msg['uuid'] = req_id
 
-        logging.debug('Sending message to backend for processing')
-        
-        self.backend_socket.send_unicode(msg['topic'], zmq.SNDMORE)
-        self.backend_socket.send_json(msg)
+        # Let the Agents know which codec the client expects the results in
+        if name != codec.JSON:
+            msg['codec'] = name
 
-    def process_backend_msg(self):
+        if rolling is not None:
+            rolling.req_id = req_id
+            self.rollouts[req_id] = rolling
+            self.route_results(req_id)
+
+        if msg.get('aggregate'):
+            deadline = time() + wait_time
+            self.aggregates[req_id] = Aggregate(req_id, expected, name)
+            heapq.heappush(self.aggregate_timers, (deadline, req_id))
+            self.route_results(req_id)
+
+        # Nothing to share when no Agents are expected to reply
+        if key and expected > 0:
+            coalesced = CoalescedRequest(req_id, key, expected, time() + self.coalesce_window)
+            self.coalescing[key] = coalesced
+            self.coalesced[req_id] = coalesced
+            heapq.heappush(self.coalesce_timers, (time() + self.coalesce_timeout, req_id))
+            self.route_results(req_id)
+
+        self.pending[req_id] = (time() + self.subscribe_timeout, msg)
+
+    def check_request(self, msg):
         """
-        Processes a message on the backend socket
+        Checks the properties of a client service request
 
-        The backend socket receives messages from Agents and contains
-        information about whether an Agent subscribes or unsubscribes.
+        Args:
+            msg (dict): The client service request
+
+        Returns:
+            A message describing the first invalid property,
+            or None if the service request is valid
 
         """
-        logging.debug('Received message on the backend socket')
+        if not isinstance(msg['topic'], basestring):
+            return 'Topic should be a string'
 
-        msg = self.backend_socket.recv()
-        topic = 'any' if not msg[1:] else msg[1:]
-        
-        if msg[0] == '\x01':
-            logging.debug('Agent subscribed to topic: %s', topic)
-        elif msg[0] == '\x00':
-            logging.debug('Agent unsubscribed from topic: %s', topic)
+        if 'batch' not in msg:
+            if not all(isinstance(msg.get(k), basestring) for k in ('service', 'cmd')):
+                return 'Service and command should be strings'
 
-    def process_sink_msg(self):
+            return None
+
+        batch = msg['batch']
+
+        if not isinstance(batch, list) or not batch:
+            return 'Batch should be a non-empty list of service requests'
+
+        for eachItem in batch:
+            if not isinstance(eachItem, dict) or not all(isinstance(eachItem.get(k), basestring) for k in ('service', 'cmd')):
+                return 'Service requests in a batch should have a service and command string'
+
+        return None
+
+    def cancel_request(self, req_id):
         """
-        Processes a message on the sink socket
+        Cancels a service request in flight
 
-        The Service Manager sink socket receives the results
-        from a service request operation from the Service Manager Agents.
+        The cancellation is broadcast to all Agents, which kill the
+        service(8) commands of the service request and send back results
+        marked with "cancelled": true. Rolling requests do not dispatch
+        any more waves.
 
-        The received message also contains the unique service request id,
-        which is later used as the topic when results are published on the
-        Result Publisher socket.
+        A coalesced request is only cancelled once none of the clients
+        sharing it is left. Until then, a client cancelling its request
+        is merely detached from the coalesced request.
+
+        Args:
+            req_id (str): The unique service request id
+
+        Returns:
+            The reply to the client
 
         """
-        logging.debug('Received message on the sink socket')
-                
-        msg = self.sink_socket.recv_json()
-        
-        logging.debug('Message: %s', msg)
+        if not isinstance(req_id, basestring):
+            return { 'success': -1, 'msg': 'Service request id should be a string' }
 
-        # Publish the results to the clients using the
-        # request id of the service request as the topic
-        self.result_pub_socket.send_unicode(msg['uuid'], zmq.SNDMORE)
-        self.result_pub_socket.send_json(msg)
+        reply = { 'success': 0, 'msg': 'Cancelling service request %s' % req_id, 'uuid': req_id }
+        coalesced = self.coalesced.get(self.followers.get(req_id, req_id))
 
-    def process_mgmt_msg(self):
+        if req_id in self.followers and coalesced is None:
+            return { 'success': -1, 'msg': 'Service request %s is no longer in flight' % req_id }
+
+        if coalesced is not None:
+            logging.info('Detaching service request %s from coalesced request %s', req_id, coalesced.req_id)
+
+            if not self.detach_coalesced(coalesced, req_id):
+                return reply
+
+            req_id = coalesced.req_id
+
+        logging.info('Cancelling service request %s', req_id)
+
+        self.stats.incr('requests_cancelled_total')
+
+        rolling = self.rollouts.get(req_id)
+
+        if rolling is not None:
+            rolling.cancel()
+            self.advance_rolling(rolling)
+
+        self.send_backend(ANY_TOPIC, { 'cancel': req_id })
+
+        return reply
+
+    def detach_coalesced(self, coalesced, req_id):
         """
-        Processes a message on the management socket
+        Detaches a client cancelling its request from a coalesced request
 
-        The management socket of Service Manager is used for
-        processing management tasks, e.g. getting status information or
-        initiating the shutdown sequence of Service Manager.
+        A coalesced request whose client cancelled no longer accepts
+        new clients, but keeps serving the clients attached to it.
 
-        The message should be in JSON format.
+        Args:
+            coalesced (CoalescedRequest): The coalesced request
+            req_id                 (str): The service request id of the client
 
-        Example management message could look like this:
-        
-            {
-                "cmd": "manager.status"
-            }
+        Returns:
+            True if no client is left and the coalesced request
+            should be cancelled, False otherwise
 
         """
-        logging.debug('Received message on the management socket')
-                
-        msg = self.mgmt_socket.recv_json()
+        if self.coalescing.get(coalesced.key) is coalesced:
+            del self.coalescing[coalesced.key]
 
-        logging.debug('Message: %s', msg)
-        
-        if not isinstance(msg, dict):
-            self.mgmt_socket.send_json({ 'success': -1, 'msg': 'Request message should be in JSON format' })
-            return
+        if req_id == coalesced.req_id:
+            coalesced.cancelled = True
+        else:
+            del coalesced.followers[req_id]
+            del self.followers[req_id]
 
-        required_attribs = (
-            'cmd',
-        )
-        
-        if not all(k in msg for k in required_attribs):
-            return { 'success': -1, 'msg': 'Missing message properties' }
+            # The client did not subscribe for results yet
+            self.pending.pop(req_id, None)
 
-        mgmt_cmds = {
-            'manager.status':   self.manager_status,
-            'manager.shutdown': self.manager_shutdown,
-        }
+        return coalesced.cancelled and not coalesced.followers
 
-        result = mgmt_cmds[msg['cmd']](msg) if mgmt_cmds.get(msg['cmd']) else { 'success': -1, 'msg': 'Uknown management command requested' }
+    def coalesce_key(self, msg, name):
+        """
+        Get the key identifying service requests which can be coalesced
 
-        self.mgmt_socket.send_json(result)
+        Only plain service requests for one of the commands configured
+        in "coalesce_cmds" are coalesced. Batch, streaming, aggregated
+        and rolling requests are always dispatched on their own, and
+        requests with different execution timeouts are not coalesced.
+
+        Args:
+            msg  (dict): The client service request
+            name  (str): Name of the codec of the service request
+
+        Returns:
+            A key identifying identical service requests, or
+            None if the service request cannot be coalesced
 
-    def manager_status(self, msg):
         """
-        Get status information about the Service Manager
+        if msg.get('cmd') not in self.coalesce_cmds:
+            return None
+
+        if 'batch' in msg or msg.get('stream') or msg.get('aggregate') or msg.get('rolling'):
+            return None
+
+        try:
+            return (msg['topic'], msg['service'], msg['cmd'], msg.get('exec_timeout'), name)
+        except TypeError:
+            # Unhashable properties are not worth coalescing
+            return None
+
+    def send_frontend_reply(self, _id, result, name=codec.JSON, tag=None):
+        """
+        Sends a reply to a client on the frontend socket
+
+        Clients having multiple requests in flight may tag their requests,
+        in which case the tag is included in the reply as well.
 
         Args:
-            msg (dict): The original management message (ignored)
+            _id     (str): Identity of the client connection
+            result (dict): The reply message
+            name    (str): Name of the codec to use
+            tag     (str): The tag of the client request
 
         """
-        result = {
-            'success': 0,
-            'msg': 'Service Manager Status',
-            'result': {
-                'status': 'running',
-                'uname': platform.uname(),
-                'frontend_endpoint': self.frontend_endpoint,
-                'backend_endpoint': self.backend_endpoint,
-                'sink_endpoint': self.sink_endpoint,
-                'mgmt_endpoint': self.mgmt_endpoint,
-                'result_publisher_port': self.result_pub_port,
-            }
-        }
+        if tag is not None:
+            result['tag'] = tag
 
-        return result
+        if result.get('success') == -1:
+            self.stats.incr('request_errors_total')
 
-    def manager_shutdown(self, msg):
+        self.frontend_socket.send(_id, zmq.SNDMORE)
+        self.frontend_socket.send("", zmq.SNDMORE)
+        codec.send(self.frontend_socket, result, name)
+
+    def dispatch_request(self, req_id):
         """
-        Initiates the Service Manager shutdown sequence
+        Sends a pending service request to the backend for processing
+
+        Clients attached to a coalesced request receive
+        the results of the coalesced request instead.
 
         Args:
-            msg (dict): The original management message received (ignored)
+            req_id (str): The service request id
 
         """
-        logging.info('Service Manager is shutting down')
+        deadline, msg = self.pending.pop(req_id)
 
-        self.time_to_die = True
+        if req_id in self.followers:
+            self.attach_follower(req_id)
+            return
 
-        return { 'success': 0, 'msg': 'Service Manager is shutting down' }
+        # Time the request waited for its client to subscribe
+        self.stats.observe('dispatch_delay_seconds', time() - deadline + self.subscribe_timeout)
+        self.stats.incr(BATCH_REQUESTS if 'batch' in msg else SERVICE_REQUESTS)
 
+        logging.debug('Sending message to backend for processing')
+
+        # Rolling requests are dispatched to their nodes in waves
+        rolling = self.rollouts.get(req_id)
+
+        if rolling is not None:
+            rolling.msg = msg
+            self.advance_rolling(rolling)
+            return
+
+        trace.stamp(msg, 'manager_dispatched')
+        
+        self.send_backend(msg['topic'], msg)
+
+        # No Agents are expected to reply, nothing to wait for
+        aggregate = self.aggregates.get(req_id)
+
+        if aggregate is not None and aggregate.is_complete():
+            self.publish_aggregate(req_id)
+
+    def send_backend(self, topic, msg, name=None):
+        """
+        Sends a service request to the Agents on the backend socket
+
+        Each message carries a sequence number, counted separately for
+        each topic. An Agent receives every message sent with the topics
+        it subscribed to, so a gap in the sequence numbers means that
+        messages were dropped, e.g. because the Agent could not keep up
+        and the high-water mark of the backend socket was reached.
+
+        Args:
+            topic  (str): The topic of the message
+            msg   (dict): The service request
+            name   (str): Name of the codec to use, the backend codec by default
+
+        """
+        seq = self.backend_seqs.get(topic, 0) + 1
+        self.backend_seqs[topic] = seq
+
+        msg['seq'] = seq
+
+        self.backend_socket.send_unicode(topic, zmq.SNDMORE)
+        codec.send(self.backend_socket, msg, name or self.backend_codec)
+
+    def dispatch_expired(self):
+        """
+        Dispatches pending service requests whose subscribe timeout expired
+
+        """
+        now = time()
+
+        while self.pending:
+            req_id, (deadline, _msg) = next(self.pending.iteritems())
+
+            if deadline > now:
+                break
+
+            logging.debug('Client did not subscribe for results of %s in time', req_id)
+            self.dispatch_request(req_id)
+
+    def publish_expired(self):
+        """
+        Publishes the aggregated results whose deadline has been reached
+
+        """
+        now = time()
+
+        while self.aggregate_timers and self.aggregate_timers[0][0] <= now:
+            _deadline, req_id = heapq.heappop(self.aggregate_timers)
+
+            # Aggregates completed before their deadline are already gone
+            if req_id in self.aggregates:
+                self.publish_aggregate(req_id)
+
+    def attach_follower(self, req_id):
+        """
+        Starts publishing the results of a coalesced request to an attached client
+
+        Results already received for the coalesced
+        request are published to the client first.
+
+        Args:
+            req_id (str): The service request id of the attached client
+
+        """
+        coalesced = self.coalesced.get(self.followers[req_id])
+
+        # The coalesced request expired before the client subscribed
+        if coalesced is None:
+            del self.followers[req_id]
+            return
+
+        coalesced.followers[req_id] = True
+
+        for eachMsg, name in coalesced.results:
+            self.publish_follower_msg(req_id, eachMsg, name)
+
+        self.forget_coalesced(coalesced)
+
+    def publish_follower_msg(self, req_id, msg, name):
+        """
+        Publishes a result of a coalesced request to an attached client
+
+        Args:
+            req_id  (str): The service request id of the attached client
+            msg    (dict): The result message of an Agent
+            name    (str): Name of the codec of the result message
+
+        """
+        self.publish(req_id, codec.encode(dict(msg, uuid=req_id), name))
+
+    def forget_coalesced(self, coalesced, force=False):
+        """
+        Forgets a coalesced request once its results are no longer needed
+
+        Completed requests no longer accept new clients, and are forgotten
+        once every attached client received the results.
+
+        Args:
+            coalesced (CoalescedRequest): The coalesced request
+            force                 (bool): Forget the request unconditionally
+
+        """
+        if not (force or coalesced.is_complete()):
+            return
+
+        if self.coalescing.get(coalesced.key) is coalesced:
+            del self.coalescing[coalesced.key]
+
+        if not force and not all(coalesced.followers.values()):
+            return
+
+        logging.debug('Forgetting coalesced request %s', coalesced.req_id)
+
+        self.coalesced.pop(coalesced.req_id, None)
+        self.unroute_results(coalesced.req_id)
+
+        for eachFollower in coalesced.followers:
+            self.followers.pop(eachFollower, None)
+
+    def coalesce_expired(self):
+        """
+        Forgets the coalesced requests whose deadline has been reached
+
+        """
+        now = time()
+
+        while self.coalesce_timers and self.coalesce_timers[0][0] <= now:
+            _deadline, req_id = heapq.heappop(self.coalesce_timers)
+
+            # Completed requests are already gone
+            if req_id in self.coalesced:
+                self.forget_coalesced(self.coalesced[req_id], force=True)
+
+    def poll_timeout(self):
+        """
+        Get the time to wait for messages in the main daemon loop
+
+        Returns:
+            The number of milliseconds until the next pending service request,
+            aggregate, coalesced or relayed request expires, the metrics should
+            be dumped, the relay should report its subscriptions, a heartbeat
+            should be sent to our peer, the registry should be checked for
+            Agents which are gone or the next wave of a rolling request
+            is due, or None if there is nothing to wait for
+
+        """
+        deadlines = []
+
+        if self.pending:
+            deadline, _msg = next(self.pending.itervalues())
+            deadlines.append(deadline)
+
+        if self.aggregate_timers:
+            deadline, _req_id = self.aggregate_timers[0]
+            deadlines.append(deadline)
+
+        if self.coalesce_timers:
+            deadline, _req_id = self.coalesce_timers[0]
+            deadlines.append(deadline)
+
+        if self.stats_file:
+            deadlines.append(self.stats_next)
+
+        if self.relay_timers:
+            deadline, _req_id = self.relay_timers[0]
+            deadlines.append(deadline)
+
+        if self.relay:
+            deadlines.append(self.relay_report_next)
+
+        if self.ha:
+            deadlines.append(self.ha_next)
+
+        if len(self.registry):
+            deadlines.append(self.registry.next_deadline())
+
+        for eachRollout in self.rollouts.itervalues():
+            deadline = eachRollout.next_deadline()
+
+            if deadline is not None:
+                deadlines.append(deadline)
+
+        if not deadlines:
+            return None
+
+        return max(0, (min(deadlines) - time()) * 1000)
+
+    def dump_stats(self):
+        """
+        Dumps the metrics to the stats file, if the stats interval has passed
+
+        """
+        if not self.stats_file or time() < self.stats_next:
+            return
+
+        self.stats.dump(self.stats_file)
+        self.stats_next = time() + self.stats_interval
+
+    def process_backend_msg(self):
+        """
+        Processes a message on the backend socket
+
+        The backend socket receives messages from Agents and contains
+        information about whether an Agent subscribes or unsubscribes.
+
+        The number of Agents subscribed to each topic is kept up to date,
+        so that we know how many Agents receive a service request.
+
+        In relay mode we subscribe to the upstream Service Manager when the
+        first Agent subscribes to a topic and unsubscribe when the last Agent
+        unsubscribes, so that service requests are relayed once per site.
+
+        """
+        logging.debug('Received message on the backend socket')
+
+        self.stats.incr(BACKEND_MESSAGES)
+
+        msg = self.backend_socket.recv()
+        topic = msg[1:]
+        
+        if msg[0] == '\x01':
+            logging.debug('Agent subscribed to topic: %s', topic)
+            self.subscriptions[topic] = self.subscriptions.get(topic, 0) + 1
+
+            if self.relay and self.subscriptions[topic] == 1:
+                self.upstream_socket.send(msg)
+        elif msg[0] == '\x00':
+            logging.debug('Agent unsubscribed from topic: %s', topic)
+            count = self.subscriptions.get(topic, 0) - 1
+
+            if count > 0:
+                self.subscriptions[topic] = count
+            else:
+                self.subscriptions.pop(topic, None)
+
+                if self.relay:
+                    self.upstream_socket.send(msg)
+
+        # Let the upstream Service Manager know how many Agents we relay to
+        if self.relay:
+            self.relay_report_next = time()
+
+    def expected_subscribers(self, topic):
+        """
+        Get the number of Agents expected to receive a topic
+
+        Subscriptions match topics by prefix, so every subscription
+        which is a prefix of the topic is taken into account.
+
+        Note, that an Agent having more than one matching subscription
+        is counted more than once, which means that the result is an
+        upper bound of the number of Agents receiving the topic.
+
+        Args:
+            topic (str): The topic of the message
+
+        Returns:
+            The number of subscribers for the topic
+
+        """
+        topic = topic.encode('utf-8')
+        counts = self.subscriber_counts()
+
+        return sum(counts.get(topic[:i], 0) for i in xrange(len(topic) + 1))
+
+    def subscriber_counts(self):
+        """
+        Get the number of Agents subscribed to each topic
+
+        A relay subscribes to a topic once, no matter how many of
+        its Agents subscribed to it, so the number of Agents reported
+        by each relay is taken into account as well.
+
+        Returns:
+            A dict of the number of subscribed Agents for each topic
+
+        """
+        if not self.relays:
+            return self.subscriptions
+
+        now = time()
+        counts = dict(self.subscriptions)
+
+        for relay_id, (expires, subscriptions) in self.relays.items():
+            if expires < now:
+                logging.info('Relay %s did not report its subscriptions in time', relay_id)
+                del self.relays[relay_id]
+                continue
+
+            for topic, count in subscriptions.iteritems():
+                topic = topic.encode('utf-8')
+                counts[topic] = counts.get(topic, 0) + max(0, count - 1)
+
+        return counts
+
+    def process_result_pub_msg(self):
+        """
+        Processes a message on the result publisher socket
+
+        The result publisher socket receives messages from clients
+        subscribing to or unsubscribing from results.
+
+        """
+        logging.debug('Received message on the result publisher socket')
+
+        self.stats.incr(RESULT_PUB_MESSAGES)
+
+        msg = self.result_pub_socket.recv()
+
+        if msg[0] == '\x01':
+            self.process_subscription(msg[1:])
+
+    def process_subscription(self, topic):
+        """
+        Processes a client subscription for results
+
+        Once a client subscribes to the results of a
+        pending service request, the request is dispatched.
+
+        Args:
+            topic (str): The topic the client subscribed to
+
+        """
+        if topic in self.pending:
+            logging.debug('Client subscribed for results of %s', topic)
+            self.dispatch_request(topic)
+
+    def process_forwarder_msg(self):
+        """
+        Processes a message from the Result Forwarder
+
+        In pipeline mode the Result Forwarder passes on client subscriptions,
+        as well as the results of service requests which need to be processed
+        by the main loop, e.g. results of aggregated or coalesced requests:
+
+            Frame 1: [ N ][...] <- Type of the message, 'subscribed' or 'result'
+            Frame 2: [ N ][...] <- Topic of the subscription or the kind of the result
+            Frame 3: [ N ][...] <- The service request id of the result
+            Frame 4: [ N ][...] <- The encoded result message
+
+        """
+        frames = self.forwarder_socket.recv_multipart()
+
+        if frames[0] == 'subscribed':
+            self.process_subscription(frames[1])
+        elif frames[0] == 'result':
+            self.process_result(*frames[1:])
+
+    def publish(self, topic, frame):
+        """
+        Publishes a message on the Result Publisher socket
+
+        In pipeline mode the message is published by the Result Forwarder.
+
+        Args:
+            topic  (str): The topic of the message, e.g. the service request id
+            frame  (str): The encoded message
+
+        """
+        topic = topic.encode('utf-8')
+
+        if self.pipeline:
+            self.forwarder_socket.send_multipart(['publish', topic, frame])
+        else:
+            self.result_pub_socket.send_multipart([topic, frame])
+
+        self.stats.incr('results_published_total')
+
+    def route_results(self, req_id):
+        """
+        Asks the Result Forwarder to pass on the results of a service request
+
+        Results of aggregated, coalesced and relayed requests are processed by
+        the main loop. Does nothing unless the Service Manager runs in pipeline mode.
+
+        Args:
+            req_id (str): The service request id
+
+        """
+        if self.pipeline:
+            self.forwarder_socket.send_multipart(['route', req_id.encode('utf-8')])
+
+    def unroute_results(self, req_id):
+        """
+        Asks the Result Forwarder to publish the results of a service request
+
+        Args:
+            req_id (str): The service request id
+
+        """
+        if self.pipeline:
+            self.forwarder_socket.send_multipart(['unroute', req_id.encode('utf-8')])
+
+    def process_sink_msg(self):
+        """
+        Processes a message on the sink socket
+
+        The Service Manager sink socket receives the results
+        from a service request operation from the Service Manager Agents.
+
+        The received message also contains the unique service request id,
+        which is later used as the topic when results are published on the
+        Result Publisher socket.
+
+        Chunks of output from streaming service requests are received
+        on the sink socket as well and are published the same way, so
+        they reach the clients in the order the Agents sent them.
+
+        The results are published as they were received, without
+        being decoded or encoded again, so that clients receive them
+        in the codec the Agent used. The Agents precede each message
+        with its kind and service request id, see codec.envelope().
+
+        Results of service requests in aggregate mode are collected
+        instead and published once the aggregate is complete.
+
+        Results of coalesced requests are published to every
+        client attached to the request as well.
+
+        """
+        logging.debug('Received message on the sink socket')
+
+        self.stats.incr(SINK_MESSAGES)
+
+        kind, req_id, frame = open_envelope(self.sink_socket.recv_multipart())
+        self.process_result(kind, req_id, frame)
+
+    def process_result(self, kind, req_id, frame):
+        """
+        Processes a message received from an Agent
+
+        Messages from relays are received on the sink socket as well,
+        i.e. reports of their subscriptions and merged results of
+        their Agents, which are processed as if each result was
+        received from the Agent directly. So are the state changes
+        of the services watched by the Agents and their heartbeats.
+
+        Args:
+            kind    (str): Kind of the message, see codec.envelope()
+            req_id  (str): The service request id
+            frame   (str): The encoded message
+
+        """
+        frame = collect_result(kind, frame)
+
+        logging.debug('Received %s message for %s', kind, req_id)
+
+        if kind == codec.RELAY:
+            msg, _codec = codec.decode(frame)
+            self.process_relay_report(msg)
+            return
+
+        if kind == codec.RELAYED:
+            msg, _codec = codec.decode(frame)
+
+            for eachMsg in msg['relayed']:
+                trace.stamp(eachMsg, 'manager_collected')
+                eachKind = codec.CHUNK if 'chunk' in eachMsg else codec.RESULT
+                self.process_result_msg(eachKind, str(eachMsg['uuid']), codec.encode(eachMsg, _codec))
+            return
+
+        if kind == codec.WATCH:
+            self.process_watch_msg(frame)
+            return
+
+        if kind == codec.HEARTBEAT:
+            self.process_heartbeat(frame)
+            return
+
+        self.process_result_msg(kind, req_id, frame)
+
+    def process_heartbeat(self, frame):
+        """
+        Processes a heartbeat of an Agent
+
+        In relay mode the heartbeat is sent to the upstream Service
+        Manager as well, so that it knows about the Agents of every site.
+
+        Args:
+            frame (str): The encoded heartbeat message
+
+        """
+        self.stats.incr('heartbeats_total')
+
+        if self.relay:
+            self.upstream_sink_socket.send_multipart([ codec.HEARTBEAT, '', frame ])
+
+        msg, _codec = codec.decode(frame)
+        self.registry.update(msg['heartbeat'])
+
+    def process_watch_msg(self, frame):
+        """
+        Publishes a state change of a watched service
+
+        In relay mode the state change is sent to the upstream
+        Service Manager as well, so that it reaches its watchers.
+
+        Args:
+            frame (str): The encoded state change message
+
+        """
+        self.stats.incr('watch_events_total')
+
+        if self.relay:
+            self.upstream_sink_socket.send_multipart([ codec.WATCH, '', frame ])
+
+        msg, _codec = codec.decode(frame)
+        self.publish(watch_topic(msg['watch']), frame)
+
+    def process_result_msg(self, kind, req_id, frame):
+        """
+        Processes a result message
+
+        The result message is only decoded if its contents are
+        needed, i.e. for rolling, aggregated and coalesced requests,
+        and for relayed requests whose results are merged.
+
+        Args:
+            kind    (str): Kind of the message, see codec.envelope()
+            req_id  (str): The service request id
+            frame   (str): The encoded result message
+
+        """
+        relayed = self.relayed.get(req_id)
+
+        if relayed is not None:
+            self.relay_result(relayed, kind, frame)
+            return
+
+        rolling = self.rollouts.get(req_id)
+
+        if rolling is not None and kind != codec.CHUNK:
+            rolling.add(codec.decode(frame)[0])
+            self.publish(req_id, frame)
+            self.advance_rolling(rolling)
+            return
+
+        aggregate = self.aggregates.get(req_id)
+
+        if aggregate is not None and kind != codec.CHUNK:
+            aggregate.add(codec.decode(frame)[0])
+
+            if aggregate.is_complete():
+                self.publish_aggregate(req_id)
+
+            return
+
+        # Publish the results to the clients using the
+        # request id of the service request as the topic
+        self.publish(req_id, frame)
+
+        coalesced = self.coalesced.get(req_id)
+
+        if coalesced is not None:
+            msg, _codec = codec.decode(frame)
+            coalesced.add(msg, _codec)
+
+            for eachFollower, subscribed in coalesced.followers.items():
+                if subscribed:
+                    self.publish_follower_msg(eachFollower, msg, _codec)
+
+            self.forget_coalesced(coalesced)
+
+    def publish_aggregate(self, req_id):
+        """
+        Publishes the aggregated results of a service request
+
+        Args:
+            req_id (str): The service request id
+
+        """
+        aggregate = self.aggregates.pop(req_id)
+        self.unroute_results(req_id)
+
+        logging.debug('Publishing aggregated results of %s', req_id)
+
+        self.publish(req_id, codec.encode(aggregate.result(), aggregate.codec))
+
+    def create_rolling(self, msg, name):
+        """
+        Creates a rolling request for the nodes receiving the topic of a service request
+
+        The nodes are taken from the registry of the Agents which are alive.
+
+        Args:
+            msg  (dict): The client service request
+            name  (str): Name of the codec of the service request
+
+        Returns:
+            A RollingRequest object
+
+        Raises:
+            ServiceManagerException if the rolling options are not valid
+            or no Agent which is alive receives the topic
+
+        """
+        options = msg['rolling']
+
+        if not isinstance(options, dict):
+            options = {}
+
+        if msg.get('aggregate'):
+            raise ServiceManagerException, 'Rolling requests cannot be aggregated'
+
+        try:
+            batch = int(options.get('batch', 1))
+            concurrency = int(options.get('concurrency', batch))
+            delay = float(options.get('delay', 0.0))
+            max_failure_ratio = float(options.get('max_failure_ratio', 1.0))
+            timeout = float(options.get('timeout', self.rolling_timeout))
+        except (TypeError, ValueError):
+            raise ServiceManagerException, 'Rolling options should be numbers'
+
+        if batch < 1 or concurrency < batch:
+            raise ServiceManagerException, 'Rolling batch should be at least 1 and at most the concurrency'
+
+        targets = sorted(self.registry.snapshot(msg['topic']))
+
+        if not targets:
+            raise ServiceManagerException, 'No live nodes receive topic %s' % msg['topic']
+
+        return RollingRequest(targets, name, batch, concurrency, delay, max_failure_ratio, timeout)
+
+    def advance_rolling(self, rolling):
+        """
+        Dispatches the next wave of a rolling request, if it is due
+
+        Each node of the wave receives the service request on its own,
+        using the name of the node as the topic. Progress messages are
+        published whenever a wave is dispatched and once the rolling
+        request is complete, see RollingRequest.progress() for details.
+
+        Args:
+            rolling (RollingRequest): The rolling request
+
+        """
+        # The client did not subscribe yet
+        if rolling.msg is None:
+            return
+
+        now = time()
+        rolling.expire(now)
+        wave = rolling.next_wave(now)
+
+        for eachNode in wave:
+            msg = dict(rolling.msg, topic=eachNode, node=eachNode)
+            trace.stamp(msg, 'manager_dispatched')
+
+            self.send_backend(eachNode, msg)
+
+        if wave:
+            logging.debug('Dispatched wave %d of %s to %d nodes', rolling.wave, rolling.req_id, len(wave))
+            self.publish(rolling.req_id, codec.encode(rolling.progress(), rolling.codec))
+
+        if rolling.is_done():
+            logging.debug('Rolling request %s is %s', rolling.req_id, rolling.state)
+            del self.rollouts[rolling.req_id]
+            self.unroute_results(rolling.req_id)
+            self.publish(rolling.req_id, codec.encode(rolling.progress(), rolling.codec))
+
+    def rolling_expired(self):
+        """
+        Dispatches the waves of rolling requests which are due
+
+        Nodes which did not reply within the timeout are counted as failed.
+
+        """
+        now = time()
+
+        for eachRollout in self.rollouts.values():
+            deadline = eachRollout.next_deadline()
+
+            if deadline is not None and deadline <= now:
+                self.advance_rolling(eachRollout)
+
+    def process_relay_report(self, msg):
+        """
+        Processes a report of the subscriptions of a relay
+
+        Relays report the number of their Agents subscribed to each topic
+        whenever it changes and every relay interval. Reports which are not
+        renewed in time are discarded.
+
+            {
+                "relay":         "<relay-id>",
+                "subscriptions": { "<topic>": <number-of-agents>, ... },
+                "ttl":           <seconds-the-report-is-valid-for>,
+            }
+
+        Args:
+            msg (dict): The report of the relay
+
+        """
+        logging.debug('Relay %s reported its subscriptions', msg['relay'])
+
+        self.relays[msg['relay']] = (time() + float(msg.get('ttl', 30.0)), msg.get('subscriptions', {}))
+
+    def process_upstream_msg(self):
+        """
+        Processes a service request from the upstream Service Manager
+
+        The service request is relayed to our Agents as it was received,
+        apart from its sequence number. The results of our Agents are merged and sent back to the upstream
+        Service Manager once every Agent replied or the relay timeout
+        expires, see RelayedRequest for details. Results of streaming
+        requests are not merged, but sent back as they arrive.
+
+        """
+        logging.debug('Received message on the upstream socket')
+
+        topic, frame = self.upstream_socket.recv_multipart()
+        msg, name = codec.decode(frame)
+
+        # Cancellations are not answered by the Agents
+        if 'cancel' in msg:
+            self.send_backend(topic.decode('utf-8'), msg, name)
+            return
+
+        logging.debug('Relaying service request %s', msg['uuid'])
+
+        relayed = RelayedRequest(
+            req_id=msg['uuid'],
+            expected=self.expected_subscribers(topic.decode('utf-8')),
+            codec=msg.get('codec') if msg.get('codec') in codec.codecs else codec.JSON,
+            merge=not msg.get('stream')
+        )
+
+        self.relayed[relayed.req_id] = relayed
+        heapq.heappush(self.relay_timers, (time() + self.relay_timeout, relayed.req_id))
+        self.route_results(relayed.req_id)
+
+        self.send_backend(topic.decode('utf-8'), msg, name)
+
+    def relay_result(self, relayed, kind, frame):
+        """
+        Relays the result of one of our Agents to the upstream Service Manager
+
+        Args:
+            relayed  (RelayedRequest): The relayed service request
+            kind                (str): Kind of the message, see codec.envelope()
+            frame               (str): The encoded result message
+
+        """
+        if not relayed.merge or relayed.sent:
+            self.upstream_sink_socket.send_multipart([ kind, str(relayed.req_id), frame ])
+            return
+
+        relayed.add(codec.decode(frame)[0])
+
+        if relayed.is_complete():
+            self.send_relayed(relayed)
+
+    def send_relayed(self, relayed):
+        """
+        Sends the merged results of our Agents to the upstream Service Manager
+
+        Args:
+            relayed (RelayedRequest): The relayed service request
+
+        """
+        relayed.sent = True
+
+        if not relayed.results:
+            return
+
+        logging.debug('Sending merged results of %s upstream', relayed.req_id)
+
+        self.upstream_sink_socket.send_multipart(codec.envelope(codec.RELAYED, relayed.result(), relayed.codec))
+
+    def relay_expired(self):
+        """
+        Sends back the merged results of relayed requests whose timeout expired
+
+        Relayed requests are remembered for another relay timeout, so
+        that results of slow Agents are still sent back as they arrive.
+
+        """
+        now = time()
+
+        while self.relay_timers and self.relay_timers[0][0] <= now:
+            _deadline, req_id = heapq.heappop(self.relay_timers)
+            relayed = self.relayed.get(req_id)
+
+            if relayed is None:
+                continue
+
+            if not relayed.sent:
+                self.send_relayed(relayed)
+                heapq.heappush(self.relay_timers, (now + self.relay_timeout, req_id))
+                continue
+
+            del self.relayed[req_id]
+            self.unroute_results(req_id)
+
+        if self.relay and self.relay_report_next <= now:
+            self.send_relay_report()
+
+    def send_relay_report(self):
+        """
+        Reports the number of our Agents subscribed to each topic upstream
+
+        """
+        report = {
+            'relay':         self.relay_id,
+            'subscriptions': self.subscriber_counts(),
+            'ttl':           self.relay_interval * 3,
+        }
+
+        self.upstream_sink_socket.send_multipart(codec.envelope(codec.RELAY, report))
+
+        self.relay_report_next = time() + self.relay_interval
+
+    def process_peer_msg(self):
+        """
+        Processes a heartbeat from our high-availability peer
+
+        Heartbeats carry the state of the peer, e.g. "active".
+
+        """
+        state = self.peer_sub_socket.recv()
+
+        logging.debug('Received heartbeat from peer in state %s', state)
+
+        self.ha.peer_state(state)
+
+    def send_heartbeat(self):
+        """
+        Sends our state to our high-availability peer, if the heartbeat interval has passed
+
+        """
+        if not self.ha or time() < self.ha_next:
+            return
+
+        self.peer_pub_socket.send(self.ha.state)
+        self.ha_next = time() + self.ha.heartbeat
+
+    def process_mgmt_msg(self):
+        """
+        Processes a message on the management socket
+
+        The management socket of Service Manager is used for
+        processing management tasks, e.g. getting status information or
+        initiating the shutdown sequence of Service Manager.
+
+        The message should be in JSON format, or any other supported
+        codec, in which case the reply is encoded with the same codec.
+
+        Example management message could look like this:
+        
+            {
+                "cmd": "manager.status"
+            }
+
+        """
+        logging.debug('Received message on the management socket')
+
+        self.stats.incr(MGMT_MESSAGES)
+                
+        msg, name = codec.recv(self.mgmt_socket)
+
+        logging.debug('Message: %s', msg)
+        
+        if not isinstance(msg, dict):
+            codec.send(self.mgmt_socket, { 'success': -1, 'msg': 'Request message should be in JSON format' }, name)
+            return
+
+        required_attribs = (
+            'cmd',
+        )
+        
+        if not all(k in msg for k in required_attribs):
+            codec.send(self.mgmt_socket, { 'success': -1, 'msg': 'Missing message properties' }, name)
+            return
+
+        mgmt_cmds = {
+            'manager.status':   self.manager_status,
+            'manager.stats':    self.manager_stats,
+            'manager.nodes':    self.manager_nodes,
+            'manager.shutdown': self.manager_shutdown,
+        }
+
+        result = mgmt_cmds[msg['cmd']](msg) if mgmt_cmds.get(msg['cmd']) else { 'success': -1, 'msg': 'Uknown management command requested' }
+
+        codec.send(self.mgmt_socket, result, name)
+
+    def manager_status(self, msg):
+        """
+        Get status information about the Service Manager
+
+        Args:
+            msg (dict): The original management message (ignored)
+
+        """
+        result = {
+            'success': 0,
+            'msg': 'Service Manager Status',
+            'result': {
+                'status': 'running',
+                'uname': platform.uname(),
+                'frontend_endpoint': self.frontend_endpoint,
+                'backend_endpoint': self.backend_endpoint,
+                'sink_endpoint': self.sink_endpoint,
+                'mgmt_endpoint': self.mgmt_endpoint,
+                'result_publisher_port': self.result_pub_port,
+                'subscriptions': self.subscriptions,
+                'aggregates': len(self.aggregates),
+                'coalesced': len(self.coalesced),
+                'pipeline': self.pipeline,
+                'relays': len(self.relays),
+                'upstream_backend_endpoint': self.upstream_backend_endpoint if self.relay else None,
+                'ha_state': self.ha.state if self.ha else None,
+                'nodes': len(self.registry),
+                'rollouts': len(self.rollouts),
+            }
+        }
+
+        return result
+
+    def manager_nodes(self, msg):
+        """
+        Get the Agents which are alive, according to their heartbeats
+
+        If the message contains a "topic", only the Agents receiving
+        service requests with that topic are returned.
+
+        Args:
+            msg (dict): The original management message
+
+        """
+        result = {
+            'success': 0,
+            'msg': 'Service Manager Nodes',
+            'result': self.registry.snapshot(msg.get('topic')),
+        }
+
+        return result
+
+    def manager_stats(self, msg):
+        """
+        Get the runtime metrics of the Service Manager
+
+        Args:
+            msg (dict): The original management message (ignored)
+
+        """
+        result = {
+            'success': 0,
+            'msg': 'Service Manager Stats',
+            'result': self.stats.snapshot(),
+        }
+
+        return result
+
+    def manager_shutdown(self, msg):
+        """
+        Initiates the Service Manager shutdown sequence
+
+        Args:
+            msg (dict): The original management message received (ignored)
+
+        """
+        logging.info('Service Manager is shutting down')
+
+        self.time_to_die = True
+
+        return { 'success': 0, 'msg': 'Service Manager is shutting down' }
+
+class ResultForwarder(object):
+    """
+    Result Forwarder class
+
+    Forwards the results of the Agents from the sink socket to the Result
+    Publisher socket on a thread of its own, when the Service Manager
+    runs in pipeline mode. Both sockets are owned by the Result Forwarder
+    once it has been started.
+
+    The Result Forwarder is connected to the main loop of the Service
+    Manager by a PAIR socket, over which it passes on client subscriptions
+    and the results of the service requests routed to the main loop.
+    The main loop sends back these commands:
+
+        [ 'route', <uuid> ]             <- Pass on the results of a service request
+        [ 'unroute', <uuid> ]           <- Publish the results of a service request
+        [ 'publish', <uuid>, <frame> ]  <- Publish a message
+        [ 'stop' ]                      <- Stop forwarding
+
+    """
+    def __init__(self, zcontext, sink_socket, result_pub_socket, endpoint, stats):
+        """
+        Initializes a new ResultForwarder object
+
+        Args:
+            zcontext          (zmq.Context): The ZeroMQ context to use
+            sink_socket        (zmq.Socket): The sink socket
+            result_pub_socket  (zmq.Socket): The Result Publisher socket
+            endpoint                  (str): Endpoint of the main loop to connect to
+            stats                   (Stats): Stats to record the forwarded messages in
+
+        """
+        self.zcontext          = zcontext
+        self.sink_socket       = sink_socket
+        self.result_pub_socket = result_pub_socket
+        self.endpoint          = endpoint
+        self.stats             = stats
+        self.routes            = set()
+        self.thread            = None
+
+    def start(self):
+        """
+        Starts the Result Forwarder thread
+
+        """
+        self.thread = threading.Thread(target=self.run, name='result-forwarder')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def join(self):
+        """
+        Waits for the Result Forwarder thread to terminate
+
+        """
+        self.thread.join()
+
+    def run(self):
+        """
+        Main Result Forwarder method
+
+        """
+        logging.debug('Result Forwarder started')
+
+        self.control_socket = self.zcontext.socket(zmq.PAIR)
+        self.control_socket.connect(self.endpoint)
+
+        zpoller = zmq.Poller()
+        zpoller.register(self.control_socket, zmq.POLLIN)
+        zpoller.register(self.sink_socket, zmq.POLLIN)
+        zpoller.register(self.result_pub_socket, zmq.POLLIN)
+
+        running = True
+
+        while running:
+            socks = dict(zpoller.poll())
+
+            # Commands are processed first, so that the routes of service
+            # requests are known before the Agents send their results
+            while running and self.control_socket.poll(0):
+                running = self.process_control_msg()
+
+            if not running:
+                break
+
+            if socks.get(self.sink_socket):
+                self.process_sink_msg()
+
+            if socks.get(self.result_pub_socket):
+                self.process_result_pub_msg()
+
+        zpoller.unregister(self.control_socket)
+        zpoller.unregister(self.sink_socket)
+        zpoller.unregister(self.result_pub_socket)
+        self.control_socket.close()
+
+        logging.debug('Result Forwarder stopped')
+
+    def process_control_msg(self):
+        """
+        Processes a command from the main loop
+
+        Returns:
+            False if the Result Forwarder should stop, True otherwise
+
+        """
+        frames = self.control_socket.recv_multipart()
+        cmd = frames[0]
+
+        if cmd == 'route':
+            self.routes.add(frames[1])
+        elif cmd == 'unroute':
+            self.routes.discard(frames[1])
+        elif cmd == 'publish':
+            self.result_pub_socket.send_multipart(frames[1:])
+        elif cmd == 'stop':
+            return False
+
+        return True
+
+    def process_sink_msg(self):
+        """
+        Processes a message on the sink socket
+
+        Results of routed service requests, messages from relays, state
+        changes of watched services and heartbeats of Agents are passed on
+        to the main loop, any other results are published right away.
+
+        """
+        self.stats.incr(SINK_MESSAGES)
+
+        kind, req_id, frame = open_envelope(self.sink_socket.recv_multipart())
+
+        # Messages of relays, state changes of watched services and
+        # heartbeats of Agents are processed by the main loop as well
+        if req_id in self.routes or kind in (codec.RELAY, codec.RELAYED, codec.WATCH, codec.HEARTBEAT):
+            self.control_socket.send_multipart(['result', kind, req_id, frame])
+            return
+
+        self.result_pub_socket.send_multipart([req_id, collect_result(kind, frame)])
+        self.stats.incr('results_published_total')
+
+    def process_result_pub_msg(self):
+        """
+        Processes a message on the result publisher socket
+
+        Client subscriptions are passed on to the main loop.
+
+        """
+        self.stats.incr(RESULT_PUB_MESSAGES)
+
+        msg = self.result_pub_socket.recv()
+
+        if msg[0] == '\x01':
+            self.control_socket.send_multipart(['subscribed', msg[1:]])
+
+class Aggregate(object):
+    """
+    Aggregate class
+
+    Collects the results of a service request in aggregate mode
+
+    """
+    def __init__(self, req_id, expected, codec):
+        """
+        Initializes a new Aggregate object
+
+        Args:
+            req_id    (str): The service request id
+            expected  (int): Number of Agents expected to reply
+            codec     (str): Codec the aggregated results are published with
+
+        """
+        self.req_id   = req_id
+        self.expected = expected
+        self.codec    = codec
+        self.results  = []
+
+    def add(self, msg):
+        """
+        Adds the result of an Agent
+
+        Args:
+            msg (dict): The result message of the Agent
+
+        """
+        self.results.append(msg)
+
+    def is_complete(self):
+        """
+        Checks whether every expected Agent replied
+
+        """
+        return len(self.results) >= self.expected
+
+    def result(self):
+        """
+        Get the aggregated results message
+
+        The aggregated message contains the results of every Agent along
+        with a summary of the service request, e.g.
+
+            {
+                "uuid":   "<unique-service-request-id>",
+                "done":   true,
+                "msg":    "Aggregated service request results",
+                "result": {
+                    "results": [ <result-from-each-agent>, ... ],
+                    "summary": {
+                        "expected":    3,
+                        "received":    2,
+                        "missing":     1,
+                        "returncodes": { "0": 1, "3": 1 },
+                        "failed":      [ "<node>" ],
+                    }
+                }
+            }
+
+        The result of a batch request is counted once for
+        each service request in the batch. Results without a
+        return code, e.g. errors, are counted as "error".
+
+        """
+        returncodes = {}
+        failed = []
+
+        for eachMsg in self.results:
+            result = eachMsg.get('result')
+            result = result if isinstance(result, dict) else {}
+            items = result.get('results', [ eachMsg ])
+            node_failed = False
+
+            for eachItem in items:
+                item = eachItem.get('result') if isinstance(eachItem, dict) else None
+                rc = item.get('returncode') if isinstance(item, dict) else None
+                key = 'error' if rc is None else str(rc)
+                returncodes[key] = returncodes.get(key, 0) + 1
+                node_failed = node_failed or rc != 0
+
+            if node_failed:
+                failed.append(result.get('node', eachMsg.get('node')))
+
+        result = {
+            'uuid': self.req_id,
+            'done': True,
+            'msg':  'Aggregated service request results',
+            'result': {
+                'results': self.results,
+                'summary': {
+                    'expected':    self.expected,
+                    'received':    len(self.results),
+                    'missing':     max(0, self.expected - len(self.results)),
+                    'returncodes': returncodes,
+                    'failed':      failed,
+                }
+            }
+        }
+
+        return result
+
+
+class CoalescedRequest(object):
+    """
+    CoalescedRequest class
+
+    Keeps track of a service request shared by clients sending
+    identical service requests while the request is in flight.
+
+    The results of the request are kept until every attached client
+    subscribed for results, so that clients attaching late receive
+    the results published before they subscribed as well.
+
+    """
+    def __init__(self, req_id, key, expected, window_end):
+        """
+        Initializes a new CoalescedRequest object
+
+        Args:
+            req_id       (str): The service request id of the dispatched request
+            key        (tuple): The key identifying identical service requests
+            expected     (int): Number of Agents expected to reply
+            window_end (float): Time until which clients may attach to the request
+
+        """
+        self.req_id     = req_id
+        self.key        = key
+        self.expected   = expected
+        self.window_end = window_end
+        self.followers  = {}
+        self.results    = []
+        self.cancelled  = False
+
+    def add(self, msg, name):
+        """
+        Adds the result of an Agent
+
+        Args:
+            msg  (dict): The result message of the Agent
+            name  (str): Name of the codec of the result message
+
+        """
+        self.results.append((msg, name))
+
+    def is_complete(self):
+        """
+        Checks whether every expected Agent replied
+
+        """
+        return len(self.results) >= self.expected
+
+class RelayedRequest(object):
+    """
+    RelayedRequest class
+
+    Collects the results of our Agents for a service request relayed from
+    an upstream Service Manager, which are sent back as a single message:
+
+        {
+            "uuid":    "<unique-service-request-id>",
+            "relayed": [ <result-from-each-agent>, ... ],
+        }
+
+    The upstream Service Manager processes each of the
+    results as if it was received from the Agent directly.
+
+    """
+    def __init__(self, req_id, expected, codec, merge=True):
+        """
+        Initializes a new RelayedRequest object
+
+        Args:
+            req_id    (str): The service request id
+            expected  (int): Number of our Agents expected to reply
+            codec     (str): Codec the merged results are sent with
+            merge    (bool): Whether the results are merged
+
+        """
+        self.req_id   = req_id
+        self.expected = expected
+        self.codec    = codec
+        self.merge    = merge
+        self.sent     = False
+        self.results  = []
+
+    def add(self, msg):
+        """
+        Adds the result of an Agent
+
+        Args:
+            msg (dict): The result message of the Agent
+
+        """
+        self.results.append(msg)
+
+    def is_complete(self):
+        """
+        Checks whether every expected Agent replied
+
+        """
+        return len(self.results) >= self.expected
+
+    def result(self):
+        """
+        Get the merged results message
+
+        """
+        return { 'uuid': self.req_id, 'relayed': self.results }
+
+class RollingRequest(object):
+    """
+    RollingRequest class
+
+    Executes a service request on a number of nodes in waves. A wave of
+    at most "batch" nodes is dispatched once at most "concurrency" nodes
+    would have the service request in flight and "delay" seconds passed
+    since there was room for it. Nodes which do not reply within the
+    timeout are counted as failed.
+
+    No more waves are dispatched once the ratio of failed nodes
+    exceeds "max_failure_ratio", checked after the first wave.
+
+    """
+    def __init__(self, targets, codec, batch, concurrency, delay, max_failure_ratio, timeout):
+        """
+        Initializes a new RollingRequest object
+
+        Args:
+            targets              (list): The nodes to execute the service request on
+            codec                 (str): Codec the progress messages are published with
+            batch                 (int): Maximum number of nodes in a wave
+            concurrency           (int): Maximum number of nodes with the request in flight
+            delay               (float): Seconds to wait before dispatching the next wave
+            max_failure_ratio   (float): Ratio of failed nodes after which no more waves are dispatched
+            timeout             (float): Seconds to wait for a node to reply
+
+        """
+        self.req_id            = None
+        self.msg               = None
+        self.targets           = targets
+        self.pending           = list(reversed(targets))
+        self.codec             = codec
+        self.batch             = batch
+        self.concurrency       = concurrency
+        self.delay             = delay
+        self.max_failure_ratio = max_failure_ratio
+        self.timeout           = timeout
+        self.inflight          = {}
+        self.succeeded         = []
+        self.failed            = []
+        self.missing           = []
+        self.wave              = 0
+        self.state             = 'running'
+        self.next_wave_at      = 0
+
+    def has_room(self):
+        """
+        Checks whether there is room for the next wave
+
+        """
+        return len(self.inflight) + min(self.batch, len(self.pending)) <= self.concurrency
+
+    def next_wave(self, now):
+        """
+        Get the nodes of the next wave, if it is due
+
+        Args:
+            now (float): The current time
+
+        Returns:
+            A list of the nodes to dispatch the service request to
+
+        """
+        if self.state != 'running' or not self.pending:
+            return []
+
+        if self.next_wave_at is None or self.next_wave_at > now or not self.has_room():
+            return []
+
+        wave = [ self.pending.pop() for _ in xrange(min(self.batch, len(self.pending))) ]
+
+        for eachNode in wave:
+            self.inflight[eachNode] = now + self.timeout
+
+        self.wave += 1
+        self.next_wave_at = now + self.delay if self.has_room() else None
+
+        return wave
+
+    def add(self, msg):
+        """
+        Adds the result of a node
+
+        Args:
+            msg (dict): The result message of the Agent
+
+        """
+        result = msg.get('result')
+        result = result if isinstance(result, dict) else {}
+        node = result.get('node', msg.get('node'))
+
+        if self.inflight.pop(node, None) is None:
+            return
+
+        items = result.get('results', [ msg ])
+        rcs = [ i.get('result', {}).get('returncode') if isinstance(i, dict) and isinstance(i.get('result'), dict) else None for i in items ]
+
+        if all(rc == 0 for rc in rcs):
+            self.succeeded.append(node)
+        else:
+            self.failed.append(node)
+
+        self.completed(time())
+
+    def expire(self, now):
+        """
+        Counts the nodes which did not reply in time as failed
+
+        Args:
+            now (float): The current time
+
+        """
+        expired = [ node for node, deadline in self.inflight.iteritems() if deadline <= now ]
+
+        for eachNode in expired:
+            del self.inflight[eachNode]
+            self.missing.append(eachNode)
+
+        if expired:
+            self.completed(now)
+
+    def completed(self, now):
+        """
+        Updates the state once nodes completed
+
+        Args:
+            now (float): The current time
+
+        """
+        processed = len(self.succeeded) + len(self.failed) + len(self.missing)
+        failed = len(self.failed) + len(self.missing)
+
+        if self.state == 'running' and processed >= min(self.batch, len(self.targets)):
+            if float(failed) / processed > self.max_failure_ratio:
+                logging.warning('Aborting rolling request %s, %d of %d nodes failed', self.req_id, failed, processed)
+                self.state = 'aborted'
+
+        if self.next_wave_at is None and self.has_room():
+            self.next_wave_at = now + self.delay
+
+        if self.is_done() and self.state == 'running':
+            self.state = 'done'
+
+    def cancel(self):
+        """
+        Stops dispatching waves of the rolling request
+
+        Nodes with the service request in flight are still waited for.
+
+        """
+        if self.state == 'running':
+            self.state = 'cancelled'
+
+    def is_done(self):
+        """
+        Checks whether no more nodes are expected to reply
+
+        """
+        return (self.state != 'running' or not self.pending) and not self.inflight
+
+    def next_deadline(self):
+        """
+        Get the time the next wave is due or the next node times out
+
+        Returns:
+            The time, or None if there is nothing to wait for
+
+        """
+        deadlines = self.inflight.values()
+
+        if self.state == 'running' and self.pending and self.next_wave_at is not None:
+            deadlines.append(self.next_wave_at)
+
+        return min(deadlines) if deadlines else None
+
+    def progress(self):
+        """
+        Get the progress message of the rolling request
+
+        The progress message of a rolling request which is complete is
+        marked with "done": true, e.g.
+
+            {
+                "uuid":     "<unique-service-request-id>",
+                "done":     true,
+                "progress": {
+                    "state":     "aborted",
+                    "wave":      2,
+                    "targets":   10,
+                    "inflight":  0,
+                    "pending":   6,
+                    "succeeded": [ "<node>", ... ],
+                    "failed":    [ "<node>" ],
+                    "missing":   [ "<node>" ],
+                }
+            }
+
+        """
+        result = {
+            'uuid': self.req_id,
+            'progress': {
+                'state':     self.state,
+                'wave':      self.wave,
+                'targets':   len(self.targets),
+                'inflight':  len(self.inflight),
+                'pending':   len(self.pending),
+                'succeeded': self.succeeded,
+                'failed':    self.failed,
+                'missing':   self.missing,
+            }
+        }
+
+        if self.is_done():
+            result['done'] = True
+
+        return result
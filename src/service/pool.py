@@ -0,0 +1,206 @@
+# Copyright (c) 2014 Marin Atanasov Nikolov <dnaeon@gmail.com>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer
+#    in this position and unchanged.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR(S) ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE AUTHOR(S) BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Service Manager worker pool module
+
+Defines a bounded pool of worker threads used by the
+Service Manager Agent for executing service requests
+outside of the Agent's main poll loop.
+
+"""
+
+import Queue
+import logging
+import threading
+
+from collections import deque
+
+import zmq
+
+# Tells a worker to terminate
+STOP = object()
+
+class WorkerPool(object):
+    """
+    Worker Pool class
+
+    Tasks are submitted to the pool along with a key. Tasks sharing a
+    key wait in a queue of their own and are executed one at a time, in
+    the order they were submitted. A key whose next task may run is put
+    on the ready queue, which any idle worker takes it from, so tasks
+    with different keys run in parallel and never wait for one another.
+
+    The worker threads never touch the sockets of the main thread.
+    Instead each worker connects a PUSH socket to the results endpoint,
+    which is bound and owned by the main thread. Tasks return the
+    frames of the encoded result message, which are sent to the
+    results endpoint.
+
+    """
+    def __init__(self, size, zcontext, endpoint):
+        """
+        Initializes a new WorkerPool object
+
+        Args:
+            size              (int): Number of worker threads
+            zcontext  (zmq.Context): The ZeroMQ context to use
+            endpoint          (str): Results endpoint the workers connect to
+
+        """
+        if size < 1:
+            raise ValueError, 'Worker pool size should be at least 1'
+
+        self.size     = size
+        self.zcontext = zcontext
+        self.endpoint = endpoint
+        self.ready    = Queue.Queue()
+        self.pending  = {}
+        self.waiting  = 0
+        self.lock     = threading.Lock()
+        self.workers  = []
+        self.local    = threading.local()
+
+    def start(self):
+        """
+        Starts the worker threads
+
+        """
+        logging.debug('Starting worker pool with %d workers', self.size)
+
+        for i in xrange(self.size):
+            worker = threading.Thread(
+                target=self.worker,
+                name='worker-%d' % i
+            )
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def stop(self):
+        """
+        Stops the worker threads
+
+        Any tasks which are already queued are processed
+        before the workers terminate.
+
+        """
+        logging.debug('Stopping worker pool')
+
+        # Keys are put back on the ready queue before they are marked
+        # as done, so this returns once every queued task completed
+        self.ready.join()
+
+        for _ in self.workers:
+            self.ready.put(STOP)
+
+        for worker in self.workers:
+            worker.join()
+
+        self.workers = []
+
+    def submit(self, key, func, *args):
+        """
+        Submits a new task to the pool
+
+        Args:
+            key        (str): Key of the tasks to execute in order
+            func  (callable): The task to execute
+
+        """
+        with self.lock:
+            self.waiting += 1
+
+            # A task for the key is already queued or running
+            if key in self.pending:
+                self.pending[key].append((func, args))
+                return
+
+            self.pending[key] = deque([ (func, args) ])
+
+        self.ready.put(key)
+
+    def queued(self):
+        """
+        Get the number of tasks waiting to be executed
+
+        Returns:
+            The number of tasks which were not started yet
+
+        """
+        return self.waiting
+
+    def send(self, frames):
+        """
+        Sends an encoded message to the results endpoint
+
+        Can only be called from within a task running on a worker.
+
+        Args:
+            frames (list): The frames of the encoded message to send
+
+        """
+        self.local.socket.send_multipart(frames)
+
+    def worker(self):
+        """
+        Main worker method
+
+        Takes the next key from the ready queue and executes its
+        oldest task. The key is put back on the ready queue if more
+        tasks were submitted for it in the meantime.
+
+        """
+        self.local.socket = self.zcontext.socket(zmq.PUSH)
+        self.local.socket.connect(self.endpoint)
+
+        while True:
+            key = self.ready.get()
+
+            if key is STOP:
+                break
+
+            with self.lock:
+                func, args = self.pending[key].popleft()
+                self.waiting -= 1
+
+            try:
+                result = func(*args)
+            except Exception:
+                logging.exception('Unable to process task')
+                result = None
+
+            if result is not None:
+                self.send(result)
+
+            with self.lock:
+                if self.pending[key]:
+                    self.ready.put(key)
+                else:
+                    del self.pending[key]
+
+            self.ready.task_done()
+
+        self.local.socket.close()
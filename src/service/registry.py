@@ -0,0 +1,297 @@
+# Copyright (c) 2014 Marin Atanasov Nikolov <dnaeon@gmail.com>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer
+#    in this position and unchanged.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR(S) ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE AUTHOR(S) BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Service Manager registry module
+
+Defines the registry of the Service Manager Agents which
+are alive, i.e. which recently sent a heartbeat.
+
+"""
+
+import logging
+
+from time import time
+
+class TimerWheel(object):
+    """
+    Timer Wheel class
+
+    A hashed timing wheel -- timers are kept in a ring of slots,
+    each slot covering the timers expiring within one tick. Adding
+    a timer and expiring the timers of a tick take constant time,
+    no matter how many timers there are, so there is no need to
+    scan every timer for the ones which expired.
+
+    Timers further away than a full turn of the wheel stay in
+    their slot until the turn they expire in.
+
+    """
+    def __init__(self, resolution=1.0, slots=512):
+        """
+        Initializes a new TimerWheel object
+
+        Args:
+            resolution  (float): Seconds covered by each slot
+            slots         (int): Number of slots in the wheel
+
+        """
+        self.resolution = resolution
+        self.slots      = [ {} for _ in xrange(slots) ]
+        self.tick       = self.tick_of(time())
+        self.count      = 0
+
+    def __len__(self):
+        return self.count
+
+    def tick_of(self, when):
+        """
+        Get the tick a point in time falls into
+
+        Args:
+            when (float): The point in time
+
+        """
+        return int(when / self.resolution)
+
+    def add(self, key, deadline):
+        """
+        Adds a timer
+
+        A key should have at most one timer in the wheel.
+
+        Args:
+            key           (str): Key of the timer
+            deadline    (float): Time the timer expires at
+
+        """
+        tick = max(self.tick_of(deadline), self.tick)
+        slot = self.slots[tick % len(self.slots)]
+
+        if key not in slot:
+            self.count += 1
+
+        slot[key] = deadline
+
+    def next_deadline(self):
+        """
+        Get the time the next tick of the wheel is due
+
+        Returns:
+            The end of the current tick, or None if there are no timers
+
+        """
+        if not self.count:
+            return None
+
+        return (self.tick + 1) * self.resolution
+
+    def expire(self, now=None):
+        """
+        Removes the timers which expired
+
+        Args:
+            now (float): The current time
+
+        Returns:
+            A list of the keys of the expired timers
+
+        """
+        now = time() if now is None else now
+        current = self.tick_of(now)
+        expired = []
+
+        # Visit every slot passed since the last call, but at most one turn
+        start = max(self.tick, current - len(self.slots) + 1)
+
+        for tick in xrange(start, current + 1):
+            slot = self.slots[tick % len(self.slots)]
+
+            for key, deadline in slot.items():
+                if deadline <= now:
+                    del slot[key]
+                    expired.append(key)
+
+        self.tick = current
+        self.count -= len(expired)
+
+        return expired
+
+class NodeEntry(object):
+    """
+    Node Entry class
+
+    The details of a Service Manager Agent kept in the registry.
+
+    """
+    __slots__ = ('node', 'system', 'version', 'topics', 'dropped', 'last_seen', 'expires', 'armed')
+
+    def __init__(self, node):
+        self.node      = node
+        self.system    = None
+        self.version   = None
+        self.topics    = None
+        self.dropped   = 0
+        self.last_seen = None
+        self.expires   = None
+        self.armed     = False
+
+class NodeRegistry(object):
+    """
+    Node Registry class
+
+    Keeps the details of the Service Manager Agents which are alive,
+    along with the time their last heartbeat was received. An Agent
+    is considered gone once it misses a number of heartbeats in a row.
+
+    Each Agent has a single timer in a timer wheel. When the timer
+    expires and the Agent sent another heartbeat in the meantime, the
+    timer is added again with the new deadline, so that heartbeats
+    themselves only update the entry of the Agent. A heartbeat only
+    adds a timer if the Agent has none, i.e. it is new or its timer
+    expired and the Agent was not removed yet.
+
+    """
+    def __init__(self, liveness=3, resolution=1.0):
+        """
+        Initializes a new NodeRegistry object
+
+        Args:
+            liveness       (int): Number of heartbeats an Agent may miss
+            resolution   (float): Seconds covered by each slot of the timer wheel
+
+        """
+        self.liveness = liveness
+        self.nodes    = {}
+        self.wheel    = TimerWheel(resolution)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def update(self, heartbeat):
+        """
+        Updates the registry with a heartbeat of an Agent
+
+        Args:
+            heartbeat (dict): The heartbeat of the Agent
+
+        """
+        node = heartbeat.get('node')
+
+        if not node:
+            return
+
+        now = time()
+        entry = self.nodes.get(node)
+
+        if entry is None:
+            logging.info('Agent on %s is alive', node)
+            entry = self.nodes[node] = NodeEntry(node)
+
+        entry.system    = heartbeat.get('system')
+        entry.version   = heartbeat.get('version')
+        entry.topics    = heartbeat.get('topics')
+        entry.dropped   = heartbeat.get('dropped', 0)
+        entry.last_seen = now
+
+        # The timer of the Agent is rescheduled only when it expires
+        entry.expires = now + float(heartbeat.get('interval', 5.0)) * self.liveness
+
+        if not entry.armed:
+            self.wheel.add(node, entry.expires)
+            entry.armed = True
+
+    def expire(self, now=None):
+        """
+        Removes the Agents which missed too many heartbeats
+
+        Returns:
+            A list of the nodes of the removed Agents
+
+        """
+        now = time() if now is None else now
+        removed = []
+
+        for eachNode in self.wheel.expire(now):
+            entry = self.nodes.get(eachNode)
+
+            if entry is None:
+                continue
+
+            entry.armed = False
+
+            if entry.expires > now:
+                self.wheel.add(eachNode, entry.expires)
+                entry.armed = True
+                continue
+
+            logging.info('Agent on %s missed its heartbeats', eachNode)
+            del self.nodes[eachNode]
+            removed.append(eachNode)
+
+        return removed
+
+    def next_deadline(self):
+        """
+        Get the time the registry should be checked for expired Agents
+
+        """
+        return self.wheel.next_deadline()
+
+    def dropped(self):
+        """
+        Get the number of service requests the Agents reported as dropped
+
+        """
+        return sum(entry.dropped for entry in self.nodes.itervalues())
+
+    def snapshot(self, topic=None):
+        """
+        Get the details of the Agents which are alive
+
+        Args:
+            topic (str): Only include the Agents receiving messages with that topic
+
+        Returns:
+            A dict of the details of each Agent by node
+
+        """
+        now = time()
+        result = {}
+
+        for node, entry in self.nodes.iteritems():
+            if topic is not None and not any(topic.startswith(t) for t in entry.topics or []):
+                continue
+
+            result[node] = {
+                'system':    entry.system,
+                'version':   entry.version,
+                'topics':    entry.topics,
+                'dropped':   entry.dropped,
+                'last_seen': entry.last_seen,
+                'age':       now - entry.last_seen,
+            }
+
+        return result
@@ -0,0 +1,84 @@
+# Copyright (c) 2014 Marin Atanasov Nikolov <dnaeon@gmail.com>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer
+#    in this position and unchanged.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR(S) ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE AUTHOR(S) BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Service Manager socket options module
+
+Defines the socket options, e.g. high-water marks, buffer sizes
+and TCP keepalive, which can be set from the configuration files.
+
+"""
+
+import logging
+
+import zmq
+
+from service.core import ServiceManagerException
+
+# Socket options which can be set from the configuration files
+SOCKOPTS = {
+    'sndhwm':              'SNDHWM',
+    'rcvhwm':              'RCVHWM',
+    'sndbuf':              'SNDBUF',
+    'rcvbuf':              'RCVBUF',
+    'linger':              'LINGER',
+    'tcp_keepalive':       'TCP_KEEPALIVE',
+    'tcp_keepalive_idle':  'TCP_KEEPALIVE_IDLE',
+    'tcp_keepalive_intvl': 'TCP_KEEPALIVE_INTVL',
+    'tcp_keepalive_cnt':   'TCP_KEEPALIVE_CNT',
+}
+
+def configure(socket, name, options):
+    """
+    Sets the configured options of a socket
+
+    Options are given as "<option>" for all sockets and as
+    "<socket>_<option>" for a single socket, e.g. "sndhwm = 10000"
+    and "backend_sndhwm = 50000", the latter taking precedence.
+
+    Must be called before the socket is bound or connected,
+    as some options only apply to connections made afterwards.
+
+    Args:
+        socket  (zmq.Socket): The socket to configure
+        name           (str): Name of the socket, e.g. "backend"
+        options       (dict): The config options
+
+    Raises:
+        ServiceManagerException if an option value is not a number
+
+    """
+    for eachOption, constant in SOCKOPTS.iteritems():
+        value = options.get('%s_%s' % (name, eachOption), options.get(eachOption))
+
+        if value is None or not hasattr(zmq, constant):
+            continue
+
+        try:
+            socket.setsockopt(getattr(zmq, constant), int(value))
+        except ValueError:
+            raise ServiceManagerException, 'Socket option %s_%s should be a number' % (name, eachOption)
+
+        logging.debug('Socket option %s of %s socket set to %s', eachOption, name, value)
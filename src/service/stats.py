@@ -0,0 +1,287 @@
+# Copyright (c) 2014 Marin Atanasov Nikolov <dnaeon@gmail.com>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer
+#    in this position and unchanged.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR(S) ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE AUTHOR(S) BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Service Manager stats module
+
+Defines the counters and latency histograms kept by the Service
+Manager and Agents. Updating a metric is a cheap dictionary update,
+any formatting is done only when the metrics are read, either by
+a management command or when they are dumped to a file.
+
+"""
+
+import os
+import bisect
+import logging
+import threading
+
+from time import time
+
+def metric(name, **labels):
+    """
+    Get the key of a metric with labels
+
+    Keys are formatted the way Prometheus formats metrics, e.g.
+    'commands_total{cmd="status"}'. Callers updating a metric
+    often should build its key once and reuse it.
+
+    Args:
+        name (str): Name of the metric
+
+    Returns:
+        The key of the metric
+
+    """
+    if not labels:
+        return name
+
+    escape = lambda v: unicode(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    pairs = ','.join('%s="%s"' % (k, escape(v)) for k, v in sorted(labels.items()))
+
+    return '%s{%s}' % (name, pairs)
+
+class Histogram(object):
+    """
+    Histogram class
+
+    Counts durations in seconds within buckets, whose upper bounds
+    double from one millisecond up to about a minute.
+
+    """
+    bounds = tuple(0.001 * 2 ** i for i in xrange(17))
+
+    def __init__(self):
+        """
+        Initializes a new Histogram object
+
+        """
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count  = 0
+        self.sum    = 0.0
+
+    def observe(self, value):
+        """
+        Adds a duration to the histogram
+
+        Args:
+            value (float): The duration in seconds
+
+        """
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def buckets(self):
+        """
+        Get the cumulative number of durations within each bucket
+
+        Returns:
+            A list of (upper-bound, count) tuples, the last
+            upper bound being '+Inf'
+
+        """
+        result = []
+        total = 0
+
+        for bound, count in zip(self.bounds + (None,), self.counts):
+            total += count
+            result.append(('+Inf' if bound is None else '%g' % bound, total))
+
+        return result
+
+class Stats(object):
+    """
+    Stats class
+
+    Keeps the counters and histograms of a daemon, along with
+    gauges, which are callables evaluated only when the metrics are read.
+
+    The metrics may be updated by the workers of the worker pool.
+
+    """
+    def __init__(self, prefix):
+        """
+        Initializes a new Stats object
+
+        Args:
+            prefix (str): Prefix of the metric names in the Prometheus format
+
+        """
+        self.prefix     = prefix
+        self.started    = time()
+        self.counters   = {}
+        self.histograms = {}
+        self.gauges     = {}
+        self.lock       = threading.Lock()
+
+        # Counters as of the last time they were read, used for rates
+        self.last_read     = self.started
+        self.last_counters = {}
+
+    def incr(self, key, value=1):
+        """
+        Increments a counter
+
+        Args:
+            key    (str): Key of the counter, see metric()
+            value  (int): Value to add to the counter
+
+        """
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, key, value):
+        """
+        Adds a duration to a histogram
+
+        Args:
+            key      (str): Key of the histogram, see metric()
+            value  (float): The duration in seconds
+
+        """
+        with self.lock:
+            histogram = self.histograms.get(key)
+
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+
+            histogram.observe(value)
+
+    def gauge(self, key, func):
+        """
+        Registers a gauge
+
+        Args:
+            key        (str): Key of the gauge, see metric()
+            func  (callable): Returns the current value of the gauge
+
+        """
+        self.gauges[key] = func
+
+    def snapshot(self):
+        """
+        Get the current value of every metric
+
+        Counter rates are calculated over the time
+        passed since the metrics were last read.
+
+        Returns:
+            A dict of the metrics
+
+        """
+        now = time()
+
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = dict(
+                (k, { 'count': h.count, 'sum': h.sum, 'buckets': h.buckets() })
+                for k, h in self.histograms.items()
+            )
+
+        elapsed = now - self.last_read
+        rates = dict(
+            (k, (v - self.last_counters.get(k, 0)) / elapsed if elapsed > 0 else 0.0)
+            for k, v in counters.items()
+        )
+
+        self.last_read = now
+        self.last_counters = counters
+
+        result = {
+            'uptime':     now - self.started,
+            'counters':   counters,
+            'rates':      rates,
+            'gauges':     dict((k, f()) for k, f in self.gauges.items()),
+            'histograms': histograms,
+        }
+
+        return result
+
+    def prometheus(self):
+        """
+        Get the metrics in the Prometheus text format
+
+        Returns:
+            The metrics as a string
+
+        """
+        lines = []
+        types = set()
+
+        def add(key, kind, value, suffix='', extra=None):
+            name, _sep, labels = key.partition('{')
+            labels = labels.rstrip('}')
+
+            if name not in types:
+                types.add(name)
+                lines.append('# TYPE %s_%s %s' % (self.prefix, name, kind))
+
+            if extra:
+                labels = ','.join(l for l in (labels, extra) if l)
+
+            labels = '{%s}' % labels if labels else ''
+            lines.append('%s_%s%s%s %s' % (self.prefix, name, suffix, labels, repr(value)))
+
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((k, h.buckets(), h.sum, h.count) for k, h in self.histograms.items())
+
+        add('uptime_seconds', 'gauge', time() - self.started)
+
+        for key, value in counters:
+            add(key, 'counter', value)
+
+        for key, func in sorted(self.gauges.items()):
+            add(key, 'gauge', func())
+
+        for key, buckets, total, count in histograms:
+            for bound, value in buckets:
+                add(key, 'histogram', value, '_bucket', 'le="%s"' % bound)
+
+            add(key, 'histogram', total, '_sum')
+            add(key, 'histogram', count, '_count')
+
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path):
+        """
+        Writes the metrics in the Prometheus text format to a file
+
+        The file is replaced atomically, so that readers
+        never see a partially written file.
+
+        Args:
+            path (str): Path to the file
+
+        """
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+
+        try:
+            with open(tmp, 'w') as f:
+                f.write(self.prometheus().encode('utf-8'))
+
+            os.rename(tmp, path)
+        except (IOError, OSError) as e:
+            logging.warning('Cannot write stats to %s: %s', path, e)
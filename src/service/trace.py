@@ -0,0 +1,128 @@
+# Copyright (c) 2014 Marin Atanasov Nikolov <dnaeon@gmail.com>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer
+#    in this position and unchanged.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR(S) ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE AUTHOR(S) BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+# THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Service Manager trace module
+
+Defines helpers for tracing service requests. A traced service request
+carries a "trace" dict, to which each hop adds the time the request
+passed it. The trace is returned to the client along with the results
+of each Agent, e.g.
+
+    {
+        "trace": {
+            "client_sent":        1412345678.001,
+            "manager_received":   1412345678.002,
+            "manager_dispatched": 1412345678.004,
+            "agent_received":     1412345678.005,
+            "agent_started":      1412345678.005,
+            "agent_finished":     1412345678.105,
+            "manager_collected":  1412345678.106,
+            "client_received":    1412345678.107,
+        }
+    }
+
+The timestamps are taken from the wall clock of each host, so the
+durations of hops between hosts include any clock skew between them.
+
+"""
+
+from time import time
+
+# Stages of a traced service request, along with the
+# hops each stage starts and ends with, in order
+STAGES = (
+    ('frontend',  'client_sent',        'manager_received'),
+    ('subscribe', 'manager_received',   'manager_dispatched'),
+    ('backend',   'manager_dispatched', 'agent_received'),
+    ('queue',     'agent_received',     'agent_started'),
+    ('service',   'agent_started',      'agent_finished'),
+    ('sink',      'agent_finished',     'manager_collected'),
+    ('publisher', 'manager_collected',  'client_received'),
+)
+
+def stamp(msg, hop):
+    """
+    Adds the current time to the trace of a traced message
+
+    Messages without a trace are left untouched.
+
+    Args:
+        msg  (dict): The message
+        hop   (str): Name of the hop, e.g. 'manager_received'
+
+    """
+    trace = msg.get('trace')
+
+    if trace is None or trace is False:
+        return
+
+    if not isinstance(trace, dict):
+        trace = msg['trace'] = {}
+
+    trace[hop] = time()
+
+def stamp_results(msg, hop):
+    """
+    Adds the current time to the traces of a result message
+
+    Aggregated result messages carry the traces of the
+    results of each Agent, which are stamped as well.
+
+    Args:
+        msg  (dict): The result message
+        hop   (str): Name of the hop, e.g. 'client_received'
+
+    """
+    stamp(msg, hop)
+
+    result = msg.get('result')
+
+    if msg.get('done') and isinstance(result, dict):
+        for eachResult in result.get('results', []):
+            if isinstance(eachResult, dict):
+                stamp(eachResult, hop)
+
+def breakdown(trace):
+    """
+    Get the time a traced service request spent in each stage
+
+    Args:
+        trace (dict): The trace of a result message
+
+    Returns:
+        A list of (stage, seconds) tuples, including the 'total' time
+        spent, where seconds is None if the trace lacks a hop
+
+    """
+    def elapsed(start, end):
+        if start in trace and end in trace:
+            return trace[end] - trace[start]
+
+        return None
+
+    result = [ (stage, elapsed(start, end)) for stage, start, end in STAGES ]
+    result.append(('total', elapsed(STAGES[0][1], STAGES[-1][2])))
+
+    return result